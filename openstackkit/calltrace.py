@@ -0,0 +1,162 @@
+# @author wtie@cisco.com
+# Record and replay calls made on api clients and remote runners.
+#
+# A trace is a gzipped json lines file, one line per call:
+#   {"c": channel, "m": method, "a": args, "k": kwargs,
+#    "r": result, "e": [exception classes of the mro, message] or null,
+#    "t": start offset in seconds, "l": latency in seconds}
+import collections
+import gzip
+import json
+import logging
+import threading
+import time
+
+LOG = logging.getLogger('calltrace')
+
+
+def _key(args, kwargs):
+    return json.dumps([args, kwargs], sort_keys=True, default=str)
+
+
+class TraceRecorder(object):
+    """Write calls to a trace file."""
+
+    def __init__(self, path):
+        self._fd = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def record(self, channel, method, args, kwargs, result, error, started,
+               latency):
+        entry = {"c": channel, "m": method, "a": args, "k": kwargs,
+                 "r": result, "e": error, "t": round(started - self._start, 6),
+                 "l": round(latency, 6)}
+        line = json.dumps(entry, separators=(',', ':'), default=str)
+        with self._lock:
+            self._fd.write(line + '\n')
+
+    def client(self, target, channel):
+        return TracingProxy(target, self, channel)
+
+    def close(self):
+        with self._lock:
+            self._fd.close()
+
+
+class TracingProxy(object):
+    """Forward calls to target and record them."""
+
+    def __init__(self, target, recorder, channel):
+        self._target = target
+        self._recorder = recorder
+        self._channel = channel
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def traced(*args, **kwargs):
+            started = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                self._recorder.record(self._channel, name, args, kwargs, None,
+                                      [[cls.__name__
+                                        for cls in type(e).__mro__],
+                                       str(e)], started,
+                                      time.time() - started)
+                raise
+            self._recorder.record(self._channel, name, args, kwargs, result,
+                                  None, started, time.time() - started)
+            return result
+        return traced
+
+
+class TraceReplayer(object):
+    """Answer calls from a trace file with the recorded results.
+
+    Calls are matched on channel, method and arguments in recorded order.
+    When the arguments differ, the next recorded call of the same method
+    answers and the mismatch is counted, or raised in strict mode.
+    Recorded exceptions are raised as the first class of their mro found
+    in exceptions. Recorded latencies are replayed multiplied by scale.
+    """
+
+    def __init__(self, path, scale=1.0, exceptions=None, strict=False):
+        self._scale = scale
+        self._exceptions = exceptions or {}
+        self._strict = strict
+        self.mismatches = 0
+        self._lock = threading.Lock()
+        self._by_key = collections.defaultdict(collections.deque)
+        self._by_method = collections.defaultdict(collections.deque)
+        self.methods = set()
+        fd = gzip.open(path, 'rb')
+        try:
+            for line in fd:
+                entry = json.loads(line)
+                # json turns tuples into lists, normalize before matching
+                key = _key(entry['a'], entry['k'])
+                entry['used'] = False
+                self._by_key[(entry['c'], entry['m'], key)].append(entry)
+                self._by_method[(entry['c'], entry['m'])].append(entry)
+                self.methods.add((entry['c'], entry['m']))
+        finally:
+            fd.close()
+
+    def _pop(self, queue):
+        while queue and queue[0]['used']:
+            queue.popleft()
+        if not queue:
+            return None
+        entry = queue.popleft()
+        entry['used'] = True
+        return entry
+
+    def call(self, channel, method, args, kwargs):
+        key = _key(json.loads(json.dumps(list(args), default=str)),
+                   json.loads(json.dumps(kwargs, default=str)))
+        with self._lock:
+            entry = self._pop(self._by_key[(channel, method, key)])
+            if entry is None and not self._strict:
+                entry = self._pop(self._by_method[(channel, method)])
+                if entry is not None:
+                    self.mismatches += 1
+                    LOG.warning("Replay %s.%s%s with recorded call of "
+                                "arguments %s" % (channel, method, key,
+                                                  _key(entry['a'],
+                                                       entry['k'])))
+        if entry is None:
+            raise Exception("No recorded call %s.%s%s left in trace" %
+                            (channel, method, key))
+        time.sleep(entry['l'] * self._scale)
+        if entry['e']:
+            names, message = entry['e']
+            if not isinstance(names, list):
+                names = [names]
+            for name in names:
+                if name in self._exceptions:
+                    raise self._exceptions[name](message)
+            raise Exception(message)
+        return entry['r']
+
+    def client(self, channel):
+        return ReplayProxy(self, channel)
+
+
+class ReplayProxy(object):
+    """Stand in for a traced object of channel."""
+
+    def __init__(self, replayer, channel):
+        self._replayer = replayer
+        self._channel = channel
+
+    def __getattr__(self, name):
+        if (self._channel, name) not in self._replayer.methods:
+            raise AttributeError(name)
+
+        def replayed(*args, **kwargs):
+            return self._replayer.call(self._channel, name, args, kwargs)
+        return replayed
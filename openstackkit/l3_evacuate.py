@@ -1,19 +1,58 @@
 #! /usr/bin/env python
 # @author wtie@cisco.com
+import contextlib
+import json
 import logging
 import os
+import socket
+import subprocess
 import time
 import itertools
-import ansible.runner
+import random
+import threading
 from logging.handlers import SysLogHandler
-from neutronclient.common.exceptions import NeutronClientException
-from neutronclient.v2_0 import client
 
 
 LOG = logging.getLogger('neutron-l3-evacuate')
 
 
-def setup_logging(enable_debug):
+class Event(object):
+    # formatted only when a handler emits the record
+    __slots__ = ('name', 'msg', 'fields')
+
+    def __init__(self, name, msg, fields):
+        self.name = name
+        self.msg = msg
+        self.fields = fields
+
+    def text(self):
+        # msg is a template for fields, never a formatted string with fields
+        if self.msg is None:
+            return " ".join("%s=%s" % (key, self.fields[key])
+                            for key in sorted(self.fields))
+        if self.fields:
+            return self.msg % self.fields
+        return self.msg
+
+    def __str__(self):
+        return "[%-12s] - %s" % (self.name.upper(), self.text())
+
+
+class JsonLinesHandler(logging.StreamHandler):
+    """Write events as json lines for downstream tooling."""
+
+    def format(self, record):
+        event = record.msg
+        entry = {"time": record.created, "level": record.levelname}
+        if isinstance(event, Event):
+            entry.update(event.fields)
+            entry.update(event=event.name, msg=event.text())
+        else:
+            entry.update(msg=record.getMessage())
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(enable_debug, events=None):
     level = logging.INFO
     if enable_debug:
         level = logging.DEBUG
@@ -23,22 +62,74 @@ def setup_logging(enable_debug):
     syslog_formatter = logging.Formatter('%(name)s: %(levelname)s %(message)s')
     syslog.setFormatter(syslog_formatter)
     LOG.addHandler(syslog)
+    if events:
+        sink = JsonLinesHandler(open(events, 'a'))
+        sink.setLevel(level)
+        LOG.addHandler(sink)
+
+
+def log_event(level, name, msg=None, **fields):
+    """Log event name with fields, msg is formatted with fields lazily."""
+    if LOG.isEnabledFor(level):
+        LOG.log(level, Event(name, msg, fields))
+
+
+def log_info(action, msg, **fields):
+    log_event(logging.INFO, action, msg, **fields)
 
 
-def log_info(action, msg):
-    LOG.info("[%-12s] - %s" % (action.upper(), msg))
+def log_warn(action, msg, **fields):
+    log_event(logging.WARNING, action, msg, **fields)
 
 
-def log_warn(action, msg):
-    LOG.warning("[%-12s] - %s" % (action.upper(), msg))
+def log_error(action, msg, **fields):
+    log_event(logging.ERROR, action, msg, **fields)
 
 
-def log_error(action, msg):
-    LOG.error("[%-12s] - %s" % (action.upper(), msg))
+def log_debug(action, msg, **fields):
+    log_event(logging.DEBUG, action, msg, **fields)
 
 
-def log_debug(action, msg):
-    LOG.debug("[%-12s] - %s" % (action.upper(), msg))
+# Plugins - runners and pickers are registered by name, external ones are
+# looked up from entry points only when selected
+RUNNER_GROUP = 'openstackkit.l3_evacuate.runners'
+PICKER_GROUP = 'openstackkit.l3_evacuate.pickers'
+RUNNERS = {}
+PICKERS = {}
+
+
+def register_runner(name):
+    def register(cls):
+        RUNNERS[name] = cls
+        return cls
+    return register
+
+
+def register_picker(name):
+    def register(cls):
+        PICKERS[name] = cls
+        return cls
+    return register
+
+
+def load_plugin(registry, group, name):
+    if name not in registry:
+        try:
+            import pkg_resources
+            for entry_point in pkg_resources.iter_entry_points(group, name):
+                registry[name] = entry_point.load()
+                break
+        except ImportError:
+            pass
+    if name not in registry:
+        raise Exception("No plugin found for %s in %s" % (name, group))
+    return registry[name]
+
+
+def neutron_client_exception():
+    # neutronclient is imported on first use to keep startup fast
+    from neutronclient.common.exceptions import NeutronClientException
+    return NeutronClientException
 
 # RemoteRunners - How to connect to remote server for checking
 
@@ -46,18 +137,41 @@ def log_debug(action, msg):
 class RemoteRunner(object):
 
     def run(self, host, cmd):
-        log_debug("run cmd", "run remote cmd [%s]: %s" % (host, cmd))
+        log_debug("run cmd", "run remote cmd [%(host)s]: %(cmd)s",
+                  host=host, cmd=cmd)
         rc, stdout, stderr = self.remote_exec(host, cmd)
         if rc != 0:
             return (False, stderr)
         else:
             return (True, stdout)
 
-
+    def run_many(self, hosts, cmd):
+        """Run cmd on all hosts in parallel, return {host: (ok, output)}."""
+        results = {}
+
+        def run_one(host):
+            try:
+                results[host] = self.run(host, cmd)
+            except Exception as e:
+                results[host] = (False, str(e))
+        threads = [threading.Thread(target=run_one, args=(host,))
+                   for host in hosts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+@register_runner('ansible')
 class AnsibleRemoteRunner(RemoteRunner):
 
+    def _runner(self, **kwargs):
+        import ansible.runner
+        return ansible.runner.Runner(**kwargs)
+
     def remote_exec(self, host, cmd):
-        results = ansible.runner.Runner(
+        results = self._runner(
             run_hosts=[host],
             module_name='shell',
             module_args=" ".join(cmd),
@@ -70,8 +184,34 @@ class AnsibleRemoteRunner(RemoteRunner):
         else:
             return (1, None, results['dark'][host])
 
+    def run_many(self, hosts, cmd):
+        # one ansible run forks to all hosts instead of a run per host
+        hosts = list(hosts)
+        if not hosts:
+            return {}
+        log_debug("run cmd", "run remote cmd on %(count)d hosts: %(cmd)s",
+                  count=len(hosts), cmd=cmd)
+        results = self._runner(
+            run_hosts=hosts,
+            module_name='shell',
+            module_args=" ".join(cmd),
+            forks=len(hosts),
+            timeout=12
+        ).run()
+        outputs = {}
+        for host in hosts:
+            if host in results['contacted']:
+                result = results['contacted'][host]
+                if result['rc'] != 0:
+                    outputs[host] = (False, result['stderr'])
+                else:
+                    outputs[host] = (True, result['stdout'])
+            else:
+                outputs[host] = (False, results['dark'].get(host))
+        return outputs
+
     def service_exec(self, host, service, action):
-        results = ansible.runner.Runner(
+        results = self._runner(
             run_hosts=[host],
             module_name='service',
             module_args={'name': service, 'state': action},
@@ -84,14 +224,240 @@ class AnsibleRemoteRunner(RemoteRunner):
             return (1, None, results['dark'][host])
 
 
+CLONE_NEWNET = 0x40000000
+_LIBC = []
+
+
+def _setns(fd):
+    if not _LIBC:
+        import ctypes
+        import ctypes.util
+        _LIBC.append(ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True))
+    if _LIBC[0].setns(fd, CLONE_NEWNET) != 0:
+        import ctypes
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+@contextlib.contextmanager
+def _enter_netns(path):
+    # setns only moves the calling thread, move it back when done
+    own = open('/proc/thread-self/ns/net'
+               if os.path.exists('/proc/thread-self') else '/proc/self/ns/net')
+    target = open(path)
+    try:
+        _setns(target.fileno())
+        try:
+            yield
+        finally:
+            _setns(own.fileno())
+    finally:
+        target.close()
+        own.close()
+
+
+@register_runner('local')
+class LocalRunner(RemoteRunner):
+    """Answer namespace queries of this host without spawning processes.
+
+    Namespaces are looked up in <root>/var/run/netns. A namespace which is
+    a directory there is read as a pre-rendered tree with proc/net/dev,
+    proc/sys/net/ipv4/ip_forward and iptables-nat (iptables-save output),
+    so the runner can be pointed to a fake tree. Other hosts are served
+    by the fallback runner.
+    """
+
+    def __init__(self, root='/', fallback='ansible'):
+        self._root = root
+        self._fallback_name = fallback
+        self._fallback = None
+        self._names = set(['localhost', socket.gethostname(),
+                           socket.getfqdn()])
+
+    def is_local(self, host):
+        return host in self._names
+
+    def _fallback_runner(self):
+        if not self._fallback:
+            self._fallback = load_plugin(RUNNERS, RUNNER_GROUP,
+                                         self._fallback_name)()
+        return self._fallback
+
+    def remote_exec(self, host, cmd):
+        if not self.is_local(host):
+            return self._fallback_runner().remote_exec(host, cmd)
+        proc = subprocess.Popen(" ".join(cmd), shell=True,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        return (proc.returncode, stdout.rstrip('\n'), stderr)
+
+    def service_exec(self, host, service, action):
+        if not self.is_local(host):
+            service_exec = getattr(self._fallback_runner(), 'service_exec',
+                                   None)
+            if callable(service_exec):
+                return service_exec(host, service, action)
+        verb = 'stop' if action == 'stopped' else 'start'
+        rc, _, _ = self.remote_exec(host, ['service', service, verb])
+        return (action if rc == 0 else None, rc == 0)
+
+    def _iptables_nat(self, base):
+        if base != self._root:
+            with open(os.path.join(base, 'iptables-nat')) as nat:
+                return nat.read()
+        # forked from this thread, so it runs in the entered namespace
+        proc = subprocess.Popen(['iptables-save', '-t', 'nat'],
+                                stdout=subprocess.PIPE)
+        return proc.communicate()[0]
+
+    def _proc(self, base):
+        if base == self._root and os.path.exists('/proc/thread-self'):
+            # /proc/self/net follows the main thread, not this one
+            return '/proc/thread-self'
+        return os.path.join(base, 'proc')
+
+    def _read_state(self, base, nat):
+        proc = self._proc(base)
+        with open(os.path.join(proc, 'net', 'dev')) as dev:
+            nics = [line.split(':')[0].strip()
+                    for line in dev.readlines()[2:]]
+        with open(os.path.join(base, 'proc', 'sys', 'net', 'ipv4',
+                               'ip_forward')) as ip_forward:
+            forward = ip_forward.read().strip()
+        state = dict(nics=[nic for nic in nics if nic != 'lo'],
+                     ip_forward=forward, nat_chains=None, nat_targets=None)
+        if not nat:
+            return state
+        # the only part which needs a process, read it only when asked
+        state['nat_chains'] = []
+        state['nat_targets'] = set()
+        for line in self._iptables_nat(base).splitlines():
+            if line.startswith(':'):
+                state['nat_chains'].append(line[1:].split()[0])
+            elif line.startswith('-A') and ' -j ' in line:
+                state['nat_targets'].add(line.split(' -j ')[1].split()[0])
+        return state
+
+    def namespace_state(self, host, namespaces, nat=False):
+        """Return {netns: state or None if absent}, None if not local.
+
+        nat_chains and nat_targets are None unless nat is True.
+        """
+        if not self.is_local(host):
+            return None
+        states = {}
+        for netns in namespaces:
+            path = os.path.join(self._root, 'var', 'run', 'netns', netns)
+            if os.path.isdir(path):
+                states[netns] = self._read_state(path, nat)
+            elif os.path.exists(path):
+                with _enter_netns(path):
+                    states[netns] = self._read_state(self._root, nat)
+            else:
+                states[netns] = None
+        return states
+
+
+# Capacity - How much load a destination host can still take
+CAPACITY_CMD = ["echo netns=$(ls -1 /var/run/netns 2>/dev/null | wc -l);",
+                "echo ovs_start=$(date +%s.%N);",
+                "/usr/bin/ovs-vsctl --timeout=5 show >/dev/null 2>&1;",
+                "echo ovs_rc=$?;",
+                "echo ovs_end=$(date +%s.%N);",
+                "echo load=$(cut -d' ' -f1 /proc/loadavg);",
+                "echo cpus=$(grep -c ^processor /proc/cpuinfo)"]
+CAPACITY_KEYS = ('netns', 'ovs_rc', 'ovs_time', 'load', 'cpus')
+
+
+class CapacityProbe(object):
+    """Probe destination hosts in parallel and score their headroom.
+
+    A host scores from 1 (idle) down to 0 when any of namespace count,
+    ovs-vsctl response time or load per cpu reaches its limit. Hosts which
+    can not be probed or whose ovsdb does not answer score 0. Results are
+    cached, so a host is probed once per evacuator.
+    """
+
+    def __init__(self, remote_runner, max_namespaces=1000, max_ovs_time=2.0,
+                 max_load=2.0):
+        self._remote_runner = remote_runner
+        self._max_namespaces = max_namespaces
+        self._max_ovs_time = max_ovs_time
+        self._max_load = max_load
+        self.stats = {}
+
+    @staticmethod
+    def parse(output):
+        values = {}
+        for line in (output or '').splitlines():
+            key, sep, value = line.partition('=')
+            if not sep:
+                continue
+            try:
+                values[key.strip()] = float(value)
+            except ValueError:
+                continue
+        if 'ovs_start' in values and 'ovs_end' in values:
+            values['ovs_time'] = values.pop('ovs_end') - \
+                values.pop('ovs_start')
+        for key in CAPACITY_KEYS:
+            if key not in values:
+                return None
+        return values
+
+    def probe(self, hosts):
+        """Return {host: stats or None}, probing hosts not seen yet."""
+        missing = [host for host in hosts if host not in self.stats]
+        if missing:
+            run_many = getattr(self._remote_runner, "run_many", None)
+            if callable(run_many):
+                results = run_many(missing, CAPACITY_CMD)
+            else:
+                results = dict((host, self._remote_runner.run(
+                    host, CAPACITY_CMD)) for host in missing)
+            for host in missing:
+                status, output = results.get(host, (False, None))
+                self.stats[host] = self.parse(output) if status else None
+                if self.stats[host] is None:
+                    log_warn("preflight", "failed to probe host %(host)s - "
+                             "%(error)s", host=host, error=output)
+        return dict((host, self.stats[host]) for host in hosts)
+
+    def score(self, stats):
+        if stats is None or stats['ovs_rc'] != 0:
+            return 0.0
+        headroom = [
+            1 - stats['netns'] / self._max_namespaces,
+            1 - stats['ovs_time'] / self._max_ovs_time,
+            1 - stats['load'] / max(stats['cpus'], 1) / self._max_load]
+        return max(0.0, min(headroom))
+
+
 # Pickers - How to select the destination for one router
+class RouterRecord(object):
+    # keep only what the pickers need, full router is fetched on dispatch
+    __slots__ = ('id', 'routes', 'agent_id')
+
+    def __init__(self, router, agent_id=None):
+        self.id = router['id']
+        self.routes = len(router.get('routes') or [])
+        self.agent_id = agent_id
+
+
 class Picker(object):
 
-    def __init__(self, neutron, src_agent):
+    page_size = 500
+
+    def __init__(self, neutron, src_agent, topology=None):
         self.client = neutron
-        agents = neutron.list_agents(agent_type='L3 agent',
-                                     admin_state_up=True,
-                                     alive=True).get('agents')
+        if topology:
+            agents = topology.agents('L3 agent')
+        else:
+            agents = neutron.list_agents(agent_type='L3 agent',
+                                         admin_state_up=True,
+                                         alive=True).get('agents')
         self._src_agent = src_agent
         self.dest = {}
         for agent in agents:
@@ -101,67 +467,246 @@ class Picker(object):
                 self.dest[agent['id']]['agent'] = agent
                 self.dest[agent['id']]['routers'] = []
         self._dest_cycle = itertools.cycle(self.dest.keys())
+        self.capacity = dict((agent_id, 1.0) for agent_id in self.dest)
+        self._remaining = 0
         self.src_router_count = None
 
+    def set_capacity(self, scores):
+        """Weight destinations by capacity score, drop those scored 0."""
+        usable = dict((agent_id, score) for agent_id, score in scores.items()
+                      if agent_id in self.dest and score > 0)
+        if not usable:
+            log_warn("preflight", "no destination agent has capacity left, "
+                     "ignore capacity scores")
+            return
+        for agent_id in self.dest.keys():
+            if agent_id not in usable:
+                log_warn("preflight", "skip agent %(agent)s on %(host)s",
+                         agent=agent_id,
+                         host=self.dest[agent_id]['agent']['host'])
+                del self.dest[agent_id]
+        self.capacity = usable
+        self._dest_cycle = itertools.cycle(self.dest.keys())
+
+    def _iter_routers(self):
+        # page through routers on source agent, a server without pagination
+        # support ignores limit and marker and returns the same routers again
+        self.src_router_count = 0
+        seen = set()
+        marker = None
+        while True:
+            query = dict(fields=['id', 'routes'], limit=self.page_size)
+            if marker:
+                query['marker'] = marker
+            routers = self.client.list_routers_on_l3_agent(
+                self._src_agent['id'], **query).get('routers', [])
+            new = [router for router in routers if router['id'] not in seen]
+            for router in new:
+                seen.add(router['id'])
+                self.src_router_count += 1
+                yield RouterRecord(router)
+            if len(routers) != self.page_size or len(new) != len(routers):
+                break
+            marker = routers[-1]['id']
+
+    def _assign(self, agent_id, record):
+        record.agent_id = agent_id
+        self.dest[agent_id]['routers'].append(record)
+        self._remaining += 1
+
+    def _pop(self, agent_id):
+        self._remaining -= 1
+        record = self.dest[agent_id]['routers'].pop()
+        try:
+            return self.client.show_router(record.id).get('router')
+        except neutron_client_exception() as e:
+            log_warn("picker", "skip router %(router)s - %(error)s",
+                     router=record.id, error=e.message)
+            return None
+
     def has_next_for_agent(self, agent):
         return len(self.dest[agent['id']]['routers']) > 0
 
     def get_next_for_agent(self, agent):
-        if self.has_next_for_agent(agent):
-            return (self.dest[agent['id']]['agent'],
-                    self.dest[agent['id']]['routers'].pop())
-        else:
-            return (None, None)
+        while self.has_next_for_agent(agent):
+            router = self._pop(agent['id'])
+            if router:
+                return (self.dest[agent['id']]['agent'], router)
+        return (None, None)
 
     def get_next(self):
         candidate = len(self.dest)
-        while candidate > 0:
+        while candidate > 0 and self._remaining > 0:
             agent_id = self._dest_cycle.next()
             candidate -= 1
             if len(self.dest[agent_id]['routers']) > 0:
-                return (self.dest[agent_id]['agent'],
-                        self.dest[agent_id]['routers'].pop())
+                router = self._pop(agent_id)
+                if router:
+                    return (self.dest[agent_id]['agent'], router)
+                candidate = len(self.dest)
             else:
                 continue
         return (None, None)
 
     def has_next(self):
-        for agent_router in self.dest.values():
-            if len(agent_router['routers']) > 0:
-                return True
-            else:
-                continue
-        return False
+        return self._remaining > 0
 
 
+@register_picker('balance')
 class BalancePicker(Picker):
 
     def init(self):
-        routers = self.client.list_routers_on_l3_agent(
-            self._src_agent['id']).get('routers', [])
-        self.src_router_count = len(routers)
         totals = {}
         for agent_id in self.dest.keys():
             totals[agent_id] = self.dest[agent_id][
                 'agent']['configurations']['routers']
-        for router in routers:
+        for record in self._iter_routers():
+            # a host with half the capacity looks twice as loaded
             agent_id = min(
-                totals.keys(), key=lambda agent_id: totals[agent_id])
-            self.dest[agent_id]['routers'].append(router)
+                totals.keys(), key=lambda agent_id:
+                (totals[agent_id] + 1) / self.capacity[agent_id])
+            self._assign(agent_id, record)
             totals[agent_id] += 1
-        return len(routers)
+        return self.src_router_count
 
 
+@register_picker('cycle')
 class CyclePicker(Picker):
 
+    def _weighted_cycle(self):
+        # smooth weighted round robin, a plain cycle when scores are equal
+        total = sum(self.capacity.values())
+        current = dict((agent_id, 0.0) for agent_id in self.dest)
+        while True:
+            for agent_id in current:
+                current[agent_id] += self.capacity[agent_id]
+            agent_id = max(sorted(current), key=lambda one: current[one])
+            current[agent_id] -= total
+            yield agent_id
+
     def init(self):
-        routers = self.client.list_routers_on_l3_agent(
-            self._src_agent['id']).get('routers', [])
-        self.src_router_count = len(routers)
-        for router in routers:
-            agent_id = self._dest_cycle.next()
-            self.dest[agent_id]['routers'].append(router)
-        return len(routers)
+        cycle = self._weighted_cycle()
+        for record in self._iter_routers():
+            agent_id = next(cycle)
+            self._assign(agent_id, record)
+        return self.src_router_count
+
+
+# Probers - How to measure dataplane outage of routers in flight
+class RouterProbe(threading.Thread):
+
+    def __init__(self, ping_async, ips, interval, deadline=1):
+        super(RouterProbe, self).__init__()
+        self.daemon = True
+        self._ping_async = ping_async
+        self._ips = ips
+        self._interval = interval
+        self._deadline = deadline
+        self._stopped = threading.Event()
+        self._pending = []
+        self.results = []
+
+    def _collect(self, block=False):
+        pending = []
+        for sent_at, ip, proc in self._pending:
+            rc = proc.wait() if block else proc.poll()
+            if rc is None:
+                pending.append((sent_at, ip, proc))
+            else:
+                self.results.append((sent_at, ip, rc))
+        self._pending = pending
+
+    def run(self):
+        # fire a new probe every interval without waiting for the previous
+        # one, so the outage resolution is not bound to the ping deadline,
+        # but keep at most one ping in flight per ip
+        while not self._stopped.is_set():
+            sent_at = time.time()
+            self._collect()
+            in_flight = set(ip for _, ip, _ in self._pending)
+            for ip in self._ips:
+                if ip not in in_flight:
+                    self._pending.append(
+                        (sent_at, ip, self._ping_async(ip, self._deadline)))
+            self._stopped.wait(self._interval)
+        self._collect(block=True)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def outage(self):
+        """Longest accumulated downtime of one ip, in seconds."""
+        outages = {}
+        down_at = {}
+        for sent_at, ip, rc in sorted(self.results):
+            if rc != 0 and ip not in down_at:
+                down_at[ip] = sent_at
+            elif rc == 0 and ip in down_at:
+                outages[ip] = outages.get(ip, 0) + sent_at - down_at.pop(ip)
+        end = max([sent_at for sent_at, _, _ in self.results] or [0])
+        for ip, since in down_at.items():
+            outages[ip] = outages.get(ip, 0) + end - since
+        return max(outages.values() or [0])
+
+
+class OutageProber(object):
+
+    def __init__(self, neutron, interval=0.2, net_uuid=None, max_ips=8):
+        # reuse the target discovery of ping_working_public, only instances
+        # which accept icmp from anywhere are worth probing
+        import ping_working_public
+        self.client = neutron
+        self._interval = interval
+        self._max_ips = max_ips
+        self._ping_async = ping_working_public.ping_async
+        self._targets = set(ping_working_public.get_floating_ips())
+        if net_uuid:
+            self._targets.update(ping_working_public.get_public_ips(net_uuid))
+        self._probes = {}
+        log_info("probe start", "%(targets)d pingable targets discovered",
+                 targets=len(self._targets))
+
+    def _select_ips(self, router):
+        floating_ips = self.client.list_floatingips(
+            router_id=router['id']).get('floatingips', [])
+        ips = [fip['floating_ip_address'] for fip in floating_ips
+               if fip['floating_ip_address'] in self._targets]
+        # a sample of max_ips is enough to see the outage and bounds the
+        # pings in flight on the evacuating host
+        random.shuffle(ips)
+        selected = []
+        while ips and len(selected) < self._max_ips:
+            batch = ips[:self._max_ips - len(selected)]
+            ips = ips[len(batch):]
+            # ignore ips which are already down before the migration
+            procs = [(ip, self._ping_async(ip)) for ip in batch]
+            selected += [ip for ip, proc in procs if proc.wait() == 0]
+        return selected
+
+    def start(self, router):
+        ips = self._select_ips(router)
+        if not ips:
+            log_debug("probe start", "no pingable floating ip behind router "
+                      "%(router)s", router=router['id'])
+            return
+        log_debug("probe start", "probing %(ips)d floating ips behind router "
+                  "%(router)s every %(interval).2f seconds", ips=len(ips),
+                  router=router['id'], interval=self._interval)
+        probe = RouterProbe(self._ping_async, ips, self._interval)
+        self._probes[router['id']] = probe
+        probe.start()
+
+    def stop(self, router):
+        probe = self._probes.pop(router['id'], None)
+        if not probe:
+            return None
+        probe.stop()
+        outage = probe.outage()
+        log_info("probe end", "router %(router)s dataplane outage "
+                 "%(duration).2f seconds", router=router['id'],
+                 duration=outage)
+        return outage
 
 
 # Evacuator - How to migate routers
@@ -172,7 +717,13 @@ class L3AgentEvacuator(object):
             self._insecure_client = True
         else:
             self._insecure_client = False
+        self._setup_trace(kwargs.get('trace'), kwargs.get('replay'),
+                          kwargs.get('replay_scale', 1.0),
+                          kwargs.get('replay_strict', False))
         self._setup_neutron_client()
+        # agents are listed once and shared by lookups and the picker
+        from topology import TopologyCache
+        self.topology = TopologyCache(self._neutron)
         if 'agent' not in kwargs and 'target' not in kwargs:
             raise Exception("Missing target hostname or agent id")
         else:
@@ -196,7 +747,7 @@ class L3AgentEvacuator(object):
                 agent_id = target_agent_id_2
             else:
                 raise Exception("Invalid target hostname or agent id")
-        self._src_agent = self._neutron.show_agent(agent_id).get('agent', {})
+        self._src_agent = self.topology.agent(agent_id)
 
         if 'stopl3' in kwargs and kwargs['stopl3'] is True:
             self._stop_agent_after_evacuate = True
@@ -226,16 +777,58 @@ class L3AgentEvacuator(object):
             self._retry = kwargs['retry']
         else:
             self._retry = 1
+        if 'probe' in kwargs and kwargs['probe'] is True:
+            self._probe = True
+        else:
+            self._probe = False
+        if "probe_interval" in kwargs:
+            self._probe_interval = kwargs['probe_interval']
+        else:
+            self._probe_interval = 0.2
+        if "probe_max_ips" in kwargs:
+            self._probe_max_ips = kwargs['probe_max_ips']
+        else:
+            self._probe_max_ips = 8
+        if 'preflight' in kwargs and kwargs['preflight'] is True:
+            self._preflight = True
+        else:
+            self._preflight = False
+        self.prober = None
+        self.outages = {}
+        self.capacity = None
 
     def _get_agent_id(self, hostname_or_id):
-        agents = self._neutron.list_agents(agent_type='L3 agent').get('agents')
-        for one_agent in agents:
-            if one_agent['id'] == hostname_or_id or \
-               one_agent['host'] == hostname_or_id:
-                return one_agent['id']
+        agent = self.topology.agent(hostname_or_id, 'L3 agent')
+        if agent and agent['agent_type'] == 'L3 agent':
+            return agent['id']
         return None
 
+    def _setup_trace(self, trace, replay, replay_scale, replay_strict=False):
+        self._recorder = None
+        self._replayer = None
+        if replay:
+            from calltrace import TraceReplayer
+            self._replayer = TraceReplayer(
+                replay, scale=replay_scale, strict=replay_strict,
+                exceptions={'NeutronClientException':
+                            neutron_client_exception()})
+        elif trace:
+            from calltrace import TraceRecorder
+            self._recorder = TraceRecorder(trace)
+
+    def close(self):
+        if self._replayer and self._replayer.mismatches:
+            log_warn("replay", "%(count)d calls answered by recorded calls "
+                     "of other arguments", count=self._replayer.mismatches)
+        if self._recorder:
+            self._recorder.close()
+            self._recorder = None
+
     def _setup_neutron_client(self):
+        if self._replayer:
+            self._neutron = self._replayer.client('neutron')
+            return
+        from neutronclient.v2_0 import client
         ca = os.environ.get('OS_CACERT', None)
 
         self._neutron = client.Client(auth_url=os.environ['OS_AUTH_URL'],
@@ -245,66 +838,109 @@ class L3AgentEvacuator(object):
                                       endpoint_type='internalURL',
                                       insecure=self._insecure_client,
                                       ca_cert=ca)
+        if self._recorder:
+            self._neutron = self._recorder.client(self._neutron, 'neutron')
 
     def _setup_picker(self, picker):
-        if picker == 'cycle':
-            self.picker = CyclePicker(self._neutron, self._src_agent)
-        elif picker == 'balance':
-            self.picker = BalancePicker(self._neutron, self._src_agent)
-        else:
-            raise Exception("No picker found for %s" % picker)
+        picker_cls = load_plugin(PICKERS, PICKER_GROUP, picker)
+        self.picker = picker_cls(self._neutron, self._src_agent,
+                                 topology=self.topology)
 
     def _setup_remote_runner(self, remote_runner):
-        if remote_runner == 'ansible':
-            self.remote_runner = AnsibleRemoteRunner()
-        else:
-            raise Exception("No remote runner found for %s" % remote_runner)
+        if self._replayer:
+            self.remote_runner = self._replayer.client('runner')
+            return
+        runner_cls = load_plugin(RUNNERS, RUNNER_GROUP, remote_runner)
+        self.remote_runner = runner_cls()
+        if self._recorder:
+            self.remote_runner = self._recorder.client(self.remote_runner,
+                                                       'runner')
+
+    def _preflight_capacity(self):
+        if not self.capacity:
+            self.capacity = CapacityProbe(self.remote_runner)
+        hosts = dict((agent_id, dest['agent']['host'])
+                     for agent_id, dest in self.picker.dest.items())
+        stats = self.capacity.probe(set(hosts.values()))
+        scores = {}
+        for agent_id, host in sorted(hosts.items()):
+            scores[agent_id] = self.capacity.score(stats[host])
+            log_info("preflight", None, agent=agent_id, host=host,
+                     score=round(scores[agent_id], 2),
+                     **(stats[host] or {}))
+        self.picker.set_capacity(scores)
 
     def run(self):
         # start time
         start_time = time.time()
         log_info("start", "------ L3 agent evacuate start ------")
+        # setup dataplane prober
+        if self._probe and not self.prober:
+            self.prober = OutageProber(self._neutron, self._probe_interval,
+                                       max_ips=self._probe_max_ips)
+        # weight destinations by their capacity
+        if self._preflight:
+            self._preflight_capacity()
         # setup picker
         count = self.picker.init()
         # init status
-        log_info("start", " %d routers need to be migrated off host %s" % (
-            count, self._src_agent['host']))
+        log_info("start", " %(count)d routers need to be migrated off host "
+                 "%(host)s", count=count, agent=self._src_agent['id'],
+                 host=self._src_agent['host'])
         # do migrate
         self.evacuate()
         if self._stop_agent_after_evacuate:
             log_info("checking start",
-                     "checking before stop neutron l3 agent service")
+                     "checking before stop neutron l3 agent service on "
+                     "%(host)s", host=self._src_agent['host'])
             left_routers = self._list_router_on_l3_agent(self._src_agent)
             if len(left_routers) == 0:
                 # no new created routers, stop service
                 log_info("checking complete",
-                         "No new router scheduled to the agent, stopping...")
+                         "No new router scheduled to the agent %(agent)s, "
+                         "stopping...", agent=self._src_agent['id'])
                 self._stop_agent(self._src_agent['host'])
                 log_info("service stop",
-                         "Service neutron-l3-agent stopped on %s"
-                         % self._src_agent['host'])
+                         "Service neutron-l3-agent stopped on %(host)s",
+                         host=self._src_agent['host'])
             else:
                 # run the whole agent evacuate again
-                log_info("summary", "Found %d new scheduled router on agent, "
-                         "retry evacuating" % len(left_routers))
+                log_info("summary", "Found %(count)d new scheduled router on "
+                         "agent %(agent)s, retry evacuating",
+                         count=len(left_routers), agent=self._src_agent['id'])
                 self.run()
         else:
             log_info("summary", "")
             left_routers = self._list_router_on_l3_agent(self._src_agent)
             if left_routers:
-                log_warn("summary",
-                         "[%d] routers are not evacuated" % len(left_routers))
+                log_warn("summary", "[%(count)d] routers are not evacuated",
+                         count=len(left_routers), agent=self._src_agent['id'])
                 for router in left_routers:
-                    log_warn("summary", "router id %s" % router['id'])
+                    log_warn("summary", "router id %(router)s",
+                             router=router['id'])
         # end time
         end_time = time.time()
         evacuated = self.picker.src_router_count
-        summary = "evacuated %d routers off agent %s [%s] in %d seconds" % (
-            evacuated, self._src_agent['id'], self._src_agent['host'],
-            end_time - start_time)
-        log_info("summary", summary)
+        # a template and its fields, the text is formatted when emitted
+        summary = "evacuated %(evacuated)d routers off agent %(agent)s " \
+            "[%(host)s] in %(duration)d seconds"
+        fields = dict(agent=self._src_agent['id'],
+                      host=self._src_agent['host'], evacuated=evacuated,
+                      duration=end_time - start_time)
+        if self.outages:
+            for router_id, outage in self.outages.items():
+                log_info("summary", "router %(router)s dataplane outage "
+                         "%(outage).2f seconds", router=router_id,
+                         outage=outage)
+            summary += ", dataplane outage max %(outage_max).2f avg " \
+                "%(outage_avg).2f seconds over %(probed)d probed routers"
+            fields.update(outage_max=max(self.outages.values()),
+                          outage_avg=sum(self.outages.values()) /
+                          len(self.outages),
+                          probed=len(self.outages))
+        log_info("summary", summary, **fields)
         log_info("completed", "------ L3 agent evacuate end ------")
-        return summary
+        return summary % fields
 
     def _list_router_on_l3_agent(self, agent):
         return self._neutron.list_routers_on_l3_agent(
@@ -334,74 +970,100 @@ class L3AgentEvacuator(object):
             return True
 
     def _check_api_removed(self, agent, router):
-        log_debug("api checking", "checking router %s removed from agent %s "
-                  "via api " % (router['id'], agent['id']))
+        log_debug("api checking", "checking router %(router)s removed from "
+                  "agent %(agent)s via api ", router=router['id'],
+                  agent=agent['id'])
         agents = self._neutron.list_l3_agent_hosting_routers(
             router['id']).get('agents', [])
         if len(agents) == 0:
-            log_debug("api checking", "router %s removed from agent %s "
-                      "successfully via api " % (router['id'], agent['id']))
+            log_debug("api checking", "router %(router)s removed from agent "
+                      "%(agent)s successfully via api ", router=router['id'],
+                      agent=agent['id'])
             return True
         else:
-            log_warn("api checking", "Router %s removed from agent %s failed "
-                     "via api " % (router['id'], agent['id']))
+            log_warn("api checking", "Router %(router)s removed from agent "
+                     "%(agent)s failed via api ", router=router['id'],
+                     agent=agent['id'])
             return False
 
     def _check_api_added(self, agent, router):
-        log_debug("api checking", "checking router %s added to agent %s via "
-                  "api " % (router['id'], agent['id']))
+        log_debug("api checking", "checking router %(router)s added to agent "
+                  "%(agent)s via api ", router=router['id'],
+                  agent=agent['id'])
         agents = self._neutron.list_l3_agent_hosting_routers(
             router['id']).get('agents', [])
         if agent['id'] in [one_agent['id'] for one_agent in agents]:
-            log_debug("api checking", "router %s added to %s successfully via "
-                      "api" % (router['id'], agent['id']))
+            log_debug("api checking", "router %(router)s added to %(agent)s "
+                      "successfully via api", router=router['id'],
+                      agent=agent['id'])
             return True
         else:
-            log_warn("api checking", "router %s added to agent %s failed via "
-                     "api" % (router['id'], agent['id']))
+            log_warn("api checking", "router %(router)s added to agent "
+                     "%(agent)s failed via api", router=router['id'],
+                     agent=agent['id'])
             return False
 
     def _ensure_clean_router_on_host(self, agent, router):
-        log_debug("ensure router clean", "ensure router %s cleaned from "
-                  "agent %s on host %s" % (router['id'], agent['id'],
-                                           agent['host']))
+        log_debug("ensure router clean", "ensure router %(router)s cleaned "
+                  "from agent %(agent)s on host %(host)s", router=router['id'],
+                  agent=agent['id'], host=agent['host'])
         host = agent['host']
         namespace = "qrouter-%s" % router['id']
         result = self._list_nics_in_netns_on_remote(host, namespace)
         if len(result) == 0:
-            log_debug("ensure router clean", "router %s remove verified from "
-                      "agent %s on host %s" % (router['id'], agent['id'],
-                                               agent['host']))
+            log_debug("ensure router clean", "router %(router)s remove "
+                      "verified from agent %(agent)s on host %(host)s",
+                      router=router['id'], agent=agent['id'],
+                      host=agent['host'])
             return True
         else:
-            log_warn("port clean", "router %s clean failed from agent %s on "
-                     "host %s - nics %s not deleted" % (router['id'],
-                                                        agent['id'],
-                                                        agent['host'],
-                                                        result))
+            log_warn("port clean", "router %(router)s clean failed from agent "
+                     "%(agent)s on host %(host)s - nics %(nics)s not deleted",
+                     router=router['id'], agent=agent['id'],
+                     host=agent['host'], nics=result)
             self._clean_nics_on_host(host, result)
             self._clean_netns_on_host(host, namespace)
-            log_info("port clean", "router %s cleaned from agent %s on host %s"
-                     " - nics %s force cleaned" % (router['id'], agent['id'],
-                                                   agent['host'], result))
+            log_info("port clean", "router %(router)s cleaned from agent "
+                     "%(agent)s on host %(host)s - nics %(nics)s force "
+                     "cleaned", router=router['id'], agent=agent['id'],
+                     host=agent['host'], nics=result)
             return True
 
+    def _namespace_state(self, host, namespace, nat=False):
+        """Return (answered, state) from runners reading netns directly."""
+        namespace_state = getattr(self.remote_runner, "namespace_state", None)
+        if not callable(namespace_state):
+            return (False, None)
+        if nat:
+            states = namespace_state(host, [namespace], nat=True)
+        else:
+            states = namespace_state(host, [namespace])
+        if states is None:
+            return (False, None)
+        return (True, states[namespace])
+
     def _verify_router_snat_rule(self, agent, router):
         host = agent['host']
         namespace = "qrouter-%s" % router['id']
-        log_debug("verify wait", "Trying to find snat rule in namespace %s on "
-                  "host [%s] as the mark of neutron finished updating" %
-                  (namespace, host))
-        cmd = self._cmd_grep_snat_rule_in_netns(namespace,
-                                                'neutron-l3-agent-snat')
-        rc, output = self.remote_runner.run(host, cmd)
+        log_debug("verify wait", "Trying to find snat rule in namespace "
+                  "%(namespace)s on host [%(host)s] as the mark of neutron "
+                  "finished updating", namespace=namespace, host=host)
+        answered, state = self._namespace_state(host, namespace, nat=True)
+        if answered:
+            rc = bool(state) and 'neutron-l3-agent-snat' in state['nat_targets']
+        else:
+            cmd = self._cmd_grep_snat_rule_in_netns(namespace,
+                                                    'neutron-l3-agent-snat')
+            rc, output = self.remote_runner.run(host, cmd)
         if rc:
-            log_info("verify wait", "Found snat rule in namespace %s on host "
-                     "[%s], neutron finished the router add" % (namespace, host))
+            log_info("verify wait", "Found snat rule in namespace "
+                     "%(namespace)s on host [%(host)s], neutron finished the "
+                     "router add", namespace=namespace, host=host)
             return True
         else:
-            log_debug("verify wait", "Failed to find snat rule in namespace %s "
-                      "on host [%s], waiting for neutron" % (namespace, host))
+            log_debug("verify wait", "Failed to find snat rule in namespace "
+                      "%(namespace)s on host [%(host)s], waiting for neutron",
+                      namespace=namespace, host=host)
             return False
 
     def _cmd_grep_snat_rule_in_netns(self, netns, rule_name):
@@ -409,33 +1071,46 @@ class L3AgentEvacuator(object):
                 "nat", "-L", "|", "grep", "^%s" % rule_name]
 
     def _verify_router_on_host(self, agent, router):
-        log_debug("router verify", "Verifying router %s added to agent %s on "
-                  "host %s" % (router['id'], agent['id'], agent['host']))
-        verify_ports = self._verify_ports_on_host(agent, router)
+        log_debug("router verify", "Verifying router %(router)s added to agent "
+                  "%(agent)s on host %(host)s", router=router['id'],
+                  agent=agent['id'], host=agent['host'])
+        # read the namespace once for both checks
+        netns_state = self._namespace_state(agent['host'],
+                                            "qrouter-%s" % router['id'])
+        verify_ports = self._verify_ports_on_host(agent, router, netns_state)
         if not verify_ports:
             return False
-        verify_ip_forward = self._verify_ipforward_on_host(agent, router)
+        verify_ip_forward = self._verify_ipforward_on_host(agent, router,
+                                                           netns_state)
         return verify_ip_forward
 
     def _cmd_show_ipforward_in_netns(self, netns):
         return ["ip", "netns", "exec", netns, 'cat',
                 '/proc/sys/net/ipv4/ip_forward']
 
-    def _verify_ipforward_on_host(self, agent, router):
+    def _verify_ipforward_on_host(self, agent, router, netns_state=None):
         host = agent['host']
         namespace = "qrouter-%s" % router['id']
-        log_debug("router verify", "Start to verify ip forward in namespace %s "
-                  "on host [%s]" % (namespace, host))
-        rc, output = self.remote_runner.run(
-            host, self._cmd_show_ipforward_in_netns(namespace))
+        log_debug("router verify", "Start to verify ip forward in namespace "
+                  "%(namespace)s on host [%(host)s]", namespace=namespace,
+                  host=host)
+        answered, state = netns_state or self._namespace_state(host,
+                                                               namespace)
+        if answered:
+            rc, output = (state is not None,
+                          state and state['ip_forward'])
+        else:
+            rc, output = self.remote_runner.run(
+                host, self._cmd_show_ipforward_in_netns(namespace))
         if rc:
             return output == "1"
         else:
             log_warn("router verify", "Failed to verify ip forward in "
-                     "namespace %s on host [%s]" % (namespace, host))
+                     "namespace %(namespace)s on host [%(host)s]",
+                     namespace=namespace, host=host)
             return False
 
-    def _verify_ports_on_host(self, agent, router):
+    def _verify_ports_on_host(self, agent, router, netns_state=None):
         host = agent['host']
         namespace = "qrouter-%s" % router['id']
         ports = self._neutron.list_ports(
@@ -443,7 +1118,8 @@ class L3AgentEvacuator(object):
         if len(ports) == 0:
             return True
         state = True
-        result = self._list_nics_in_netns_on_remote(host, namespace)
+        result = self._list_nics_in_netns_on_remote(host, namespace,
+                                                    netns_state)
         for one_port in ports:
             if one_port['device_owner'] == 'network:router_interface':
                 nic = "qr-%s" % one_port['id'][0:11]
@@ -452,16 +1128,20 @@ class L3AgentEvacuator(object):
             else:
                 continue
             verfied = nic in result
-            log_debug("port verify", "verify router %s added to agent %s on "
-                      "host %s - %s : %s" % (router['id'], agent['id'],
-                                             agent['host'], nic, verfied))
+            log_debug("port verify", "verify router %(router)s added to agent "
+                      "%(agent)s on host %(host)s - %(nic)s : %(verified)s",
+                      router=router['id'], agent=agent['id'],
+                      host=agent['host'], nic=nic, verified=verfied)
             state = state & verfied
         return state
 
     def _cmd_list_nic_in_netns(self, netns):
         return ["ip", "netns", "exec", netns, "ls", "-1", "/sys/class/net/"]
 
-    def _list_nics_in_netns_on_remote(self, host, netns):
+    def _list_nics_in_netns_on_remote(self, host, netns, netns_state=None):
+        answered, state = netns_state or self._namespace_state(host, netns)
+        if answered:
+            return state['nics'] if state else []
         rc, output = self.remote_runner.run(
             host, self._cmd_list_nic_in_netns(netns))
         if rc:
@@ -486,8 +1166,8 @@ class L3AgentEvacuator(object):
 
     def _clean_nics_on_host(self, host, nics):
         for one_nic in nics:
-            log_debug("port deleting", "start deleting port %s on host %s"
-                      % (one_nic, host))
+            log_debug("port deleting", "start deleting port %(nic)s on host "
+                      "%(host)s", nic=one_nic, host=host)
             if 'qg-' in one_nic:
                 succeed, output = self.remote_runner.run(
                     host, self._cmd_delete_ovs_port(one_nic,
@@ -501,16 +1181,18 @@ class L3AgentEvacuator(object):
                     host, self._cmd_delete_ovs_port(one_nic))
             if not succeed:
                 log_warn(
-                    "port deleting", "Failed to delete port %s on host %s - "
-                    "%s" % (one_nic, host, output))
+                    "port deleting", "Failed to delete port %(nic)s on host "
+                    "%(host)s - %(error)s", nic=one_nic, host=host,
+                    error=output)
 
     def _clean_netns_on_host(self, host, namespace):
         succeed, output = self.remote_runner.run(
             host, self._cmd_delete_netns(namespace))
         if not succeed:
             log_warn("netns deleting",
-                     "Failed to delete netns %s on host %s - %s" %
-                     (namespace, host, output))
+                     "Failed to delete netns %(namespace)s on host %(host)s - "
+                     "%(error)s", namespace=namespace, host=host,
+                     error=output)
 
     def _stop_agent(self, host):
         service_exec = getattr(self.remote_runner, "service_exec", None)
@@ -525,16 +1207,18 @@ class L3AgentEvacuator(object):
             cmd = ["service", "neutron-l3-agent", "stop"]
             result, _ = self.remote_runner.run(host, cmd)
         if not result:
-            log_error("service stop", "Failed to stop neutron-l3-agent")
+            log_error("service stop", "Failed to stop neutron-l3-agent on "
+                      "%(host)s", host=host)
         else:
-            log_info("service stop", "Stopped neutron-l3-agent")
+            log_info("service stop", "Stopped neutron-l3-agent on %(host)s",
+                     host=host)
 
 
 class SequenceEvacuator(L3AgentEvacuator):
 
     def _remove_router(self, agent, router, retry=0):
-        log_debug("remove start", "remove router %s from %s" %
-                  (router['id'], agent['id']))
+        log_debug("remove start", "remove router %(router)s from %(agent)s",
+                  router=router['id'], agent=agent['id'])
         need_retry = False
         try:
             self._neutron.remove_router_from_l3_agent(
@@ -542,12 +1226,13 @@ class SequenceEvacuator(L3AgentEvacuator):
             if not self._wait_until(self._check_api_removed, agent, router):
                 need_retry = True
                 log_warn("api remove failed",
-                         "failed to remove router %s from agent %s"
-                         % (router['id'], agent['id']))
-        except NeutronClientException as e:
+                         "failed to remove router %(router)s from agent "
+                         "%(agent)s", router=router['id'], agent=agent['id'])
+        except neutron_client_exception() as e:
             need_retry = True
-            log_warn("neutron exception", "remove router %s from "
-                     "agent %s - %s" % (router['id'], agent['id'], e.message))
+            log_warn("neutron exception", "remove router %(router)s from "
+                     "agent %(agent)s - %(error)s", router=router['id'],
+                     agent=agent['id'], error=e.message)
         finally:
             if not need_retry:
                 return True
@@ -560,29 +1245,32 @@ class SequenceEvacuator(L3AgentEvacuator):
         try:
             # clean left qg qr devices if they are not cleaned by neutron
             self._ensure_clean_router_on_host(agent, router)
-            log_debug("remove ensured", "remove router %s from agent %s" %
-                      (router['id'], agent['id']))
+            log_debug("remove ensured", "remove router %(router)s from agent "
+                      "%(agent)s", router=router['id'], agent=agent['id'])
             return True
         except Exception as e:
-            log_warn("ensure exception", "exception ensure clean router %s from agent"
-                     " %s - %s" % (router['id'], agent['id'], e.message))
+            log_warn("ensure exception", "exception ensure clean router "
+                     "%(router)s from agent %(agent)s - %(error)s",
+                     router=router['id'], agent=agent['id'], error=e.message)
             return False
 
     def _add_router(self, agent, router, retry=0):
-        log_debug("add start", "add router %s to agent %s" %
-                  (router['id'], agent['id']))
+        log_debug("add start", "add router %(router)s to agent %(agent)s",
+                  router=router['id'], agent=agent['id'])
         need_retry = False
         try:
             self._neutron.add_router_to_l3_agent(
                 agent['id'], dict(router_id=router['id']))
             if not self._wait_until(self._check_api_added, agent, router):
                 need_retry = True
-                log_warn("api add failed", "failed add router %s to agent %s" %
-                         (router['id'], agent['id']))
-        except NeutronClientException as e:
+                log_warn("api add failed", "failed add router %(router)s to "
+                         "agent %(agent)s", router=router['id'],
+                         agent=agent['id'])
+        except neutron_client_exception() as e:
             need_retry = True
-            log_warn("neutron exception", "exception add router %s to agent %s - %s" %
-                     (router['id'], agent['id'], e.message))
+            log_warn("neutron exception", "exception add router %(router)s to "
+                     "agent %(agent)s - %(error)s", router=router['id'],
+                     agent=agent['id'], error=e.message)
         finally:
             if not need_retry:
                 return True
@@ -604,29 +1292,33 @@ class SequenceEvacuator(L3AgentEvacuator):
                 # wait again, since port with multi floating ip takes
                 # time to add
                 extra_timeout = self._extra_timeout_for_router(router)
-                log_warn("verify add failed", "failed to verify router %s on "
-                         "agent %s, wait for another %d seconds" %
-                         (router['id'], agent['id'], extra_timeout))
+                log_warn("verify add failed", "failed to verify router "
+                         "%(router)s on agent %(agent)s, wait for another "
+                         "%(timeout)d seconds", router=router['id'],
+                         agent=agent['id'], timeout=extra_timeout)
                 added = self._wait_until(self._verify_router_on_host,
                                          agent, router,
                                          wait_timeout=extra_timeout,
                                          least_wait_time=1, wait_interval=1)
                 if not added:
-                    log_error("verify add failed", "failed to add router %s on "
-                              "agent %s, please verify manually" % (router['id'],
-                                                                    agent['id']))
+                    log_error("verify add failed", "failed to add router "
+                              "%(router)s on agent %(agent)s, please verify "
+                              "manually", router=router['id'],
+                              agent=agent['id'])
                     return False
                 else:
-                    log_debug("add complete", "add router %s to agent %s" %
-                              (router['id'], agent['id']))
+                    log_debug("add complete", "add router %(router)s to agent "
+                              "%(agent)s", router=router['id'],
+                              agent=agent['id'])
                     return True
             else:
-                log_debug("add complete", "add router %s to agent %s" %
-                          (router['id'], agent['id']))
+                log_debug("add complete", "add router %(router)s to agent "
+                          "%(agent)s", router=router['id'], agent=agent['id'])
                 return True
         except Exception as e:
-            log_error("verify error", "Error - check router %s on "
-                      "agent %s - %s" % (router['id'], agent['id'], e.message))
+            log_error("verify error", "Error - check router %(router)s on "
+                      "agent %(agent)s - %(error)s", router=router['id'],
+                      agent=agent['id'], error=e.message)
             return True
 
     def _extra_timeout_for_router(self, router):
@@ -651,8 +1343,9 @@ class SequenceEvacuator(L3AgentEvacuator):
                     self._ensure_router_cleaned(src_agent, router)
                 return True
             else:
-                log_error("add error", "Router %s migrate failed, need verify"
-                          " manually" % router['id'])
+                log_error("add error", "Router %(router)s migrate failed, "
+                          "need verify manually", router=router['id'],
+                          agent=agent['id'])
         else:
             # add it back to src_agent
             self._add_router(src_agent, router, self._retry)
@@ -662,12 +1355,33 @@ class SequenceEvacuator(L3AgentEvacuator):
     def migrate_router(self, target_agent, router, src_agent=None):
         if not src_agent:
             src_agent = self._src_agent
-        log_info("migrate start", "Start migrate router %s from %s to %s" % (
-            router['id'], src_agent['id'], target_agent['id']))
+        log_info("migrate start", "Start migrate router %(router)s from "
+                 "%(agent)s to %(target)s", router=router['id'],
+                 agent=src_agent['id'], target=target_agent['id'],
+                 phase="start")
+        start_time = time.time()
+        if self.prober:
+            self.prober.start(router)
+        try:
+            self._migrate_router(target_agent, router, src_agent)
+        finally:
+            if self.prober:
+                outage = self.prober.stop(router)
+                if outage is not None:
+                    self.outages[router['id']] = outage
+
+        log_info("migrate end", "End migrate router %(router)s from %(agent)s "
+                 "to %(target)s", router=router['id'],
+                 agent=self._src_agent['id'], target=target_agent['id'],
+                 host=target_agent['host'], phase="end",
+                 duration=time.time() - start_time)
+
+    def _migrate_router(self, target_agent, router, src_agent):
         removed = self._remove_router(src_agent, router, self._retry)
         if removed:
-            log_info("router removed", "Removed router %s from %s" % (
-                router['id'], src_agent['id']))
+            log_info("router removed", "Removed router %(router)s from "
+                     "%(agent)s", router=router['id'], agent=src_agent['id'],
+                     phase="removed")
             added = self._add_router(target_agent, router, self._retry)
             ports = self._neutron.list_ports(
                 device_id=router['id'], admin_state_up=True).get('ports', [])
@@ -686,16 +1400,15 @@ class SequenceEvacuator(L3AgentEvacuator):
                 self._retry_failed_router(router, src_agent, self._retry)
         else:
             # if remove failed, left it there for next loop
-            log_warn("remove failed", "Failed remove router %s from %s by api" % (
-                router['id'], src_agent['id']))
-
-        log_info("migrate end", "End migrate router %s from %s to %s" %
-                 (router['id'], self._src_agent['id'], target_agent['id']))
+            log_warn("remove failed", "Failed remove router %(router)s from "
+                     "%(agent)s by api", router=router['id'],
+                     agent=src_agent['id'])
 
     def evacuate(self):
         while self.picker.has_next():
             agent, router = self.picker.get_next()
-            self.migrate_router(agent, router)
+            if router:
+                self.migrate_router(agent, router)
 
 
 if __name__ == '__main__':
@@ -709,20 +1422,56 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("agent_id", help="l3 agent id to evacuate")
     parser.add_argument("--picker",
-                        choices=['cycle', 'balance'],
-                        help="method to distribute",
+                        help="method to distribute, builtin: %s" %
+                             ", ".join(sorted(PICKERS)),
                         default='cycle')
     parser.add_argument("--runner",
-                        choices=['ansible'],
-                        help="method to run remote command",
+                        help="method to run remote command, builtin: %s" %
+                             ", ".join(sorted(RUNNERS)),
                         default="ansible")
     parser.add_argument("--stopl3", action="store_true",
                         help="stop neutron-l3-agent after evacuate",
                         default=False)
+    parser.add_argument("--probe", action="store_true",
+                        help="measure dataplane outage of migrated routers",
+                        default=False)
+    parser.add_argument("--probe-interval", type=float,
+                        help="interval in seconds between two probes",
+                        default=0.2)
+    parser.add_argument("--probe-max-ips", type=int,
+                        help="max floating ips probed per router",
+                        default=8)
+    parser.add_argument("--preflight", action="store_true",
+                        help="probe destination hosts load and weight them "
+                             "by capacity", default=False)
+    parser.add_argument("--trace",
+                        help="record neutron and remote runner calls to file")
+    parser.add_argument("--replay",
+                        help="replay neutron and remote runner calls from a "
+                             "trace file instead of calling them")
+    parser.add_argument("--replay-scale", type=float, default=1.0,
+                        help="multiply replayed call latencies by this")
+    parser.add_argument("--replay-strict", action="store_true",
+                        default=False,
+                        help="fail replayed calls not recorded with the "
+                             "same arguments")
+    parser.add_argument("--events",
+                        help="append structured events as json lines to file")
     parser.add_argument('-d', '--debug', action='store_true',
                         default=False, help='Show debugging output')
     args = parser.parse_args()
 
-    setup_logging(args.debug)
-    SequenceEvacuator(args.agent_id, args.picker, args.runner,
-                      stop_agent_after_evacuate=args.stopl3).run()
+    setup_logging(args.debug, args.events)
+    evacuator = SequenceEvacuator(agent=args.agent_id, picker=args.picker,
+                                  remote_runner=args.runner,
+                                  stopl3=args.stopl3, probe=args.probe,
+                                  probe_interval=args.probe_interval,
+                                  probe_max_ips=args.probe_max_ips,
+                                  preflight=args.preflight,
+                                  trace=args.trace, replay=args.replay,
+                                  replay_scale=args.replay_scale,
+                                  replay_strict=args.replay_strict)
+    try:
+        evacuator.run()
+    finally:
+        evacuator.close()
@@ -2,44 +2,71 @@
 # This script will replace instance's ports with the same settings.
 # It will have a network downtime for the instance.
 #
-# usage: nova_interface_reset.py [-h] [-k] uuid
+# usage: nova_interface_reset.py [-h] [-k] [--prestage] [--host HOST]
+#                                [--network NETWORK] [--concurrency N]
+#                                [--per-host N] [--scan] [uuid ...]
 # positional arguments:
-#   uuid            instance uuid
+#   uuid               instance uuid
 # optional arguments:
-#   -h, --help      show this help message and exit
-#   -k, --insecure  allow connections to SSL sites without certs
+#   -h, --help         show this help message and exit
+#   -k, --insecure     allow connections to SSL sites without certs
+#   --prestage         prepare replacement before detaching old port
+#   --host HOST        reset all instances on compute host HOST
+#   --network NETWORK  reset all instances with a port on network NETWORK
+#   --concurrency N    max instances reset at the same time
+#   --per-host N       max instances reset at the same time on one host
+#   --scan             only reset ports found broken by a health scan
 #
 import argparse
 from copy import deepcopy
 import json
 import logging
 import os
+import Queue
+import threading
 import time
 
 from novaclient.v1_1.client import Client as nova_client
 from neutronclient.v2_0 import client as neutron_client
+from qvo_tag_add import QvoTagger, qvo_name, tap_name, ssh_exec
+from topology import TopologyCache
 
 logging.basicConfig(level=logging.INFO, date_fmt='%m-%d %H:%M')
 LOG = logging.getLogger('nova-interface-reset')
 
+# options consumed by NovaInterfaceResetter, not by the clients
+RESETTER_OPTIONS = ('wait_interval', 'wait_timeout', 'release_timeout',
+                    'prestage')
+
+
+def nova_from_args(args):
+    nova_args = deepcopy(args)
+    return nova_client(nova_args.pop('username'), nova_args.pop('password'),
+                       nova_args.pop('tenant_name'), **nova_args)
+
 
 class NovaInterfaceResetter(object):
     """NovaInterfaceResetter."""
 
     def __init__(self, **args):
-        """Init NovaInterfaceResetter."""
-        self._wait_interval = args.pop('wait_interval', 1)
-        self._neutron = neutron_client.Client(**args)
-        nova_args = deepcopy(args)
-        self._nova = nova_client(nova_args.pop('username'),
-                                 nova_args.pop('password'),
-                                 nova_args.pop('tenant_name'), **nova_args)
+        """Init NovaInterfaceResetter.
+
+        Clients given as neutron and nova are used instead of creating them.
+        """
+        self._wait_interval = args.pop('wait_interval', 0.5)
+        self._wait_timeout = args.pop('wait_timeout', 20)
+        self._release_timeout = args.pop('release_timeout', 2)
+        self._prestage = args.pop('prestage', False)
+        neutron = args.pop('neutron', None)
+        nova = args.pop('nova', None)
+        self._neutron = neutron or neutron_client.Client(**args)
+        self._nova = nova or nova_from_args(args)
 
     def _wait_until(self, func, *args, **kwargs):
-        """Wait until function returned true."""
+        """Wait until function returned true, False on timeout."""
         wait_time = 0
-        wait_timeout = 20
-        wait_interval = 1
+        wait_timeout = kwargs.pop('wait_timeout', None) or self._wait_timeout
+        wait_interval = self._wait_interval
 
         while wait_time <= wait_timeout:
             if not func(*args, **kwargs):
@@ -52,10 +79,33 @@ class NovaInterfaceResetter(object):
         else:
             return True
 
-    def _floatingip_port_binding(self, floatingip_id, port_id):
-        """Check floatingip and port binding."""
-        floatingip = self._neutron.show_floatingip(floatingip_id)['floatingip']
-        return floatingip['port_id'] == port_id
+    def _floatingips_state(self, bindings, status=None):
+        """Check floatingips are bound as {id: port_id} and in status."""
+        floating_ips = self._neutron.list_floatingips(
+            id=list(bindings))['floatingips']
+        if len(floating_ips) != len(bindings):
+            return False
+        for floating_ip in floating_ips:
+            if floating_ip['port_id'] != bindings[floating_ip['id']]:
+                return False
+            if status and floating_ip['status'] != status:
+                return False
+        return True
+
+    def _update_floatingips(self, bindings):
+        """Bind floatingips as {floatingip_id: port_id} without waiting."""
+        # clients are not thread safe, the updates are sent in a row and
+        # only the wait for them is shared
+        for floatingip_id, port_id in sorted(bindings.items()):
+            self._neutron.update_floatingip(
+                floatingip_id, {'floatingip': {'port_id': port_id}})
+
+    def _wait_floatingips(self, bindings, status=None, wait_timeout=None):
+        """Wait for all floatingips of bindings at once."""
+        if not bindings:
+            return True
+        return self._wait_until(self._floatingips_state, bindings, status,
+                                wait_timeout=wait_timeout)
 
     def _port_state(self, query, absent=False):
         """Check port meet query state."""
@@ -65,42 +115,26 @@ class NovaInterfaceResetter(object):
         else:
             return len(ports) == 1
 
-    def replace_port(self, port_id):
-        """Replace a port.
+    def prepare_port(self, port_id, port=None, floating_ips=None,
+                     server=None):
+        """Fetch and validate all data needed to replace a port.
 
-        steps:
-            1. disassociate all floating ips from the port
-            2. dettach the old port from instance
-            3. create new port with the same data of old port
-            4. attach the new port back to instance
-            5. associate floating ips to new port
+        Data already fetched by the caller is reused as is.
         """
-        LOG.info("Replace port %s" % port_id)
-        # get data of old port
-        old_port = self._neutron.show_port(port_id).get('port')
+        start_time = time.time()
+        old_port = port or self._neutron.show_port(port_id).get('port')
         LOG.info("Old port info: %s " % json.dumps(old_port))
-
-        # disassociate floating ip from the port
-        floating_ips = self._neutron.list_floatingips(
-            port_id=old_port['id'])['floatingips']
-        for floating_ip in floating_ips:
-            LOG.info("Disassociate floating ip %s "
-                     "from old port %s" % (floating_ip['id'], old_port['id']))
-            self._neutron.update_floatingip(floating_ip['id'],
-                                            {'floatingip': {'port_id': None}})
-            self._wait_until(self._floatingip_port_binding,
-                             floating_ip['id'], None)
-        time.sleep(self._wait_interval)
-        # get server
-        server = self._nova.servers.get(old_port['device_id'])
+        if not old_port.get('device_owner', '').startswith('compute:'):
+            raise Exception("Port %s is not used by an instance" % port_id)
+        if not old_port['mac_address'] or not old_port['fixed_ips']:
+            raise Exception("Port %s has no mac address or fixed ip, can not "
+                            "be recreated" % port_id)
+        if floating_ips is None:
+            floating_ips = self._neutron.list_floatingips(
+                port_id=old_port['id'])['floatingips']
+        if server is None:
+            server = self._nova.servers.get(old_port['device_id'])
         LOG.info("Servier info: %s " % json.dumps(server.to_dict()))
-        # dettach the old port from instance
-        LOG.info("Detach old port %s from server %s." % (old_port['id'],
-                                                         server.id))
-        server.interface_detach(old_port['id'])
-        self._wait_until(self._port_state, dict(id=old_port['id']),
-                         absent=True)
-        # create new port
         new_port = {"port": dict(admin_state_up=old_port['admin_state_up'],
                                  network_id=old_port['network_id'],
                                  mac_address=old_port['mac_address'],
@@ -108,36 +142,445 @@ class NovaInterfaceResetter(object):
                                  name=old_port['name'],
                                  fixed_ips=old_port['fixed_ips'],
                                  security_groups=old_port['security_groups'])}
+        return dict(old_port=old_port, floating_ips=floating_ips,
+                    server=server, new_port=new_port, start_time=start_time)
+
+    def _detach_port(self, server, old_port):
+        """Detach the old port and make sure it is gone."""
+        LOG.info("Detach old port %s from server %s." % (old_port['id'],
+                                                         server.id))
+        server.interface_detach(old_port['id'])
+        if not self._wait_until(self._port_released, old_port['id']):
+            raise Exception("Old port %s not detached from server %s" % (
+                old_port['id'], server.id))
+        ports = self._neutron.list_ports(id=old_port['id'])['ports']
+        if ports and not ports[0]['device_id']:
+            # nova only unbinds ports it did not create itself
+            LOG.info("Delete old port %s." % old_port['id'])
+            self._neutron.delete_port(old_port['id'])
+            if not self._wait_until(self._port_state,
+                                    dict(id=old_port['id']), absent=True):
+                raise Exception("Old port %s not deleted" % old_port['id'])
+
+    def _attach_port(self, server, new_port):
+        """Create the new port and attach it to the server."""
         new_port = self._neutron.create_port(new_port).get('port')
-        self._wait_until(self._port_state, dict(id=old_port['id']))
+        self._wait_until(self._port_state, dict(id=new_port['id']))
         LOG.info("Created new port %s." % json.dumps(new_port))
 
         # attach the new port back to instance
         LOG.info("Attach new port %s to server %s." % (new_port['id'],
                                                        server.id))
         server.interface_attach(new_port['id'], None, None)
-        self._wait_until(self._port_state,
-                         dict(id=new_port['id'], device_id=server.id))
+        if not self._wait_until(self._port_state,
+                                dict(id=new_port['id'], device_id=server.id)):
+            raise Exception("New port %s not attached to server %s" % (
+                new_port['id'], server.id))
+        return new_port
+
+    def _disassociate_floatingips(self, staged_ports):
+        """Disassociate floating ips of all ports at once."""
+        bindings = {}
+        active = {}
+        for staged in staged_ports:
+            for floating_ip in staged['floating_ips']:
+                LOG.info("Disassociate floating ip %s from old port %s" % (
+                    floating_ip['id'], staged['old_port']['id']))
+                bindings[floating_ip['id']] = None
+                if floating_ip['status'] == 'ACTIVE':
+                    active[floating_ip['id']] = None
+        self._update_floatingips(bindings)
+        if not self._wait_floatingips(bindings):
+            raise Exception("Floating ips %s not disassociated" %
+                            sorted(bindings))
+        # give the l3 agent a short time to remove the active floating ips,
+        # those already down have nothing to remove
+        if not self._wait_floatingips(active, 'DOWN', self._release_timeout):
+            LOG.warning("Floating ips %s still active after %s seconds, "
+                        "l3 agent may be down" % (sorted(active),
+                                                  self._release_timeout))
 
-        # associate floating ips to new port
+    def _associate_floatingips(self, floating_ips, new_port):
+        """Associate floating ips to the new port, return the bindings."""
+        bindings = {}
         for floating_ip in floating_ips:
             LOG.info("Associate floating ip %s "
-                     "to new port %s" % (floating_ip['id'], old_port['id']))
-            self._neutron.update_floatingip(floating_ip['id'],
-                                            {'floatingip': {'port_id':
-                                                            new_port['id']}})
-            self._wait_until(self._floatingip_port_binding,
-                             floating_ip['id'], new_port['id'])
-        LOG.info("Replace port %s with new port %s done" % (old_port['id'],
-                                                            new_port['id']))
-
-    def reset_instance(self, uuid):
-        """Reset all ports of an instance."""
+                     "to new port %s" % (floating_ip['id'], new_port['id']))
+            bindings[floating_ip['id']] = new_port['id']
+        self._update_floatingips(bindings)
+        return bindings
+
+    def _port_released(self, port_id):
+        """Check port is deleted or unbound from its instance."""
+        ports = self._neutron.list_ports(id=port_id)['ports']
+        return len(ports) == 0 or not ports[0]['device_id']
+
+    def _replace_ports(self, staged_ports):
+        """Replace prepared ports of one server, see replace_port."""
+        down_time = time.time()
+        if not self._prestage:
+            self._disassociate_floatingips(staged_ports)
+        results = []
+        bindings = {}
+        for i, staged in enumerate(staged_ports):
+            old_port = staged['old_port']
+            # with prestage the port loses connectivity at detach
+            port_down_time = time.time() if self._prestage else down_time
+            try:
+                self._detach_port(staged['server'], old_port)
+                new_port = self._attach_port(staged['server'],
+                                             staged['new_port'])
+            except Exception:
+                if not self._prestage:
+                    # ports not replaced yet keep their floating ips
+                    self._update_floatingips(dict(
+                        (floating_ip['id'], left['old_port']['id'])
+                        for left in staged_ports[i + 1:]
+                        for floating_ip in left['floating_ips']))
+                raise
+            bindings.update(self._associate_floatingips(
+                staged['floating_ips'], new_port))
+            end_time = time.time()
+            LOG.info("Replace port %s with new port %s done, downtime %.2f "
+                     "seconds" % (old_port['id'], new_port['id'],
+                                  end_time - port_down_time))
+            results.append(dict(port_id=old_port['id'],
+                                new_port_id=new_port['id'],
+                                downtime=end_time - port_down_time,
+                                elapsed=end_time - staged['start_time']))
+        if not self._wait_floatingips(bindings):
+            LOG.error("Floating ips %s not associated to the new ports" %
+                      sorted(bindings))
+        return results
+
+    def replace_port(self, port_id, port=None, floating_ips=None,
+                     server=None):
+        """Replace a port.
+
+        steps:
+            1. disassociate all floating ips from the port
+            2. dettach the old port from instance
+            3. create new port with the same data of old port
+            4. attach the new port back to instance
+            5. associate floating ips to new port
+
+        With prestage, the old port, floating ips and server are fetched
+        and validated before anything is changed, and step 1 is skipped
+        since neutron releases the floating ips with the old port. Only
+        steps 2 to 5 happen inside the downtime window.
+        """
+        LOG.info("Replace port %s" % port_id)
+        return self._replace_ports([self.prepare_port(port_id, port,
+                                                      floating_ips, server)])[0]
+
+    def reset_instance(self, uuid, port_ids=None):
+        """Reset ports of an instance, return timings of each port.
+
+        All ports are reset unless port_ids is given. Floating ips of all
+        ports are disassociated together and waited for together.
+        """
         ports = self._neutron.list_ports(device_id=uuid).get('ports', [])
+        if port_ids is not None:
+            ports = [port for port in ports if port['id'] in port_ids]
         LOG.info("Reset %d ports for instance %s " % (len(ports), uuid))
-        for port in ports:
-            self.replace_port(port['id'])
+        if not ports:
+            return []
+        # one call for floating ips of all ports, one call for the server
+        floating_ips = self._neutron.list_floatingips(
+            port_id=[port['id'] for port in ports])['floatingips']
+        server = self._nova.servers.get(uuid)
+        staged_ports = [self.prepare_port(
+            port['id'], port=port, server=server,
+            floating_ips=[floating_ip for floating_ip in floating_ips
+                          if floating_ip['port_id'] == port['id']])
+            for port in ports]
+        results = self._replace_ports(staged_ports)
         LOG.info("Reset %d ports for instance %s done" % (len(ports), uuid))
+        return results
+
+
+class PortHealthScanner(object):
+    """Find the ports of instances which are actually broken.
+
+    A port is broken when its tap or qvo device is missing on the host, the
+    qvo has no local vlan tag, the binding failed or points to another host
+    than the instance, or a floating ip of the port is not active. Ports and
+    floating ips are listed once, each host is visited once and in parallel
+    for its ovs snapshot and server list.
+
+    Clients are not thread safe, nova_factory is called by each worker for
+    its own nova client.
+    """
+
+    def __init__(self, neutron, nova_factory, remote_exec=ssh_exec,
+                 concurrency=16, topology=None):
+        """Init PortHealthScanner."""
+        self._neutron = neutron
+        self._nova_factory = nova_factory
+        self._topology = topology or TopologyCache(neutron)
+        self._tagger = QvoTagger(neutron, remote_exec, self._topology)
+        self._concurrency = concurrency
+
+    def _scan_host(self, queue, host_uuids, hosts):
+        nova = None
+        while True:
+            try:
+                host = queue.get_nowait()
+            except Queue.Empty:
+                return
+            state = dict(snapshot=None, servers={}, error=None)
+            try:
+                state['snapshot'] = self._tagger.snapshot(host)
+                if nova is None:
+                    nova = self._nova_factory()
+                servers = nova.servers.list(
+                    search_opts={'all_tenants': 1, 'host': host})
+                state['servers'] = dict((server.id, server)
+                                        for server in servers)
+            except Exception as e:
+                LOG.error("Failed to scan host %s - %s" % (host, e))
+                state['error'] = str(e)
+            for uuid in host_uuids[host]:
+                if uuid not in state['servers'] and state['error'] is None:
+                    # the instance is not on the host its port is bound to
+                    try:
+                        state['servers'][uuid] = nova.servers.get(uuid)
+                    except Exception as e:
+                        LOG.error("Failed to get server %s - %s" % (uuid, e))
+            hosts[host] = state
+
+    def _check_port(self, port, floating_ips, server, snapshot):
+        problems = []
+        if port.get('binding:vif_type') in ('binding_failed', 'unbound'):
+            problems.append("binding %s" % port['binding:vif_type'])
+        server_host = getattr(server, 'OS-EXT-SRV-ATTR:host', None)
+        if server_host and server_host != port.get('binding:host_id'):
+            problems.append("bound to %s, instance on %s" % (
+                port.get('binding:host_id'), server_host))
+        if snapshot is not None:
+            qvo = qvo_name(port['id'])
+            if not snapshot.plugged(tap_name(port['id'])):
+                problems.append("tap %s missing" % tap_name(port['id']))
+            if not snapshot.on_bridge(qvo):
+                problems.append("qvo %s missing" % qvo)
+            elif snapshot.tag(qvo) is None:
+                problems.append("qvo %s has no tag" % qvo)
+        fixed_ips = set(fixed_ip['ip_address']
+                        for fixed_ip in port['fixed_ips'])
+        for floating_ip in floating_ips:
+            if floating_ip['status'] != 'ACTIVE' or \
+                    floating_ip['fixed_ip_address'] not in fixed_ips:
+                problems.append("floating ip %s not bound" %
+                                floating_ip['floating_ip_address'])
+        return problems
+
+    def scan(self, uuids):
+        """Return {uuid: {port_id: [problem] or None if not checked}}."""
+        uuids = list(uuids)
+        report = dict((uuid, {}) for uuid in uuids)
+        if not uuids:
+            return report
+        ports = [port for device_ports in
+                 self._topology.device_ports(uuids).values()
+                 for port in device_ports]
+        floating_ips = {}
+        if ports:
+            for floating_ip in self._neutron.list_floatingips(
+                    port_id=[port['id'] for port in ports])['floatingips']:
+                floating_ips.setdefault(floating_ip['port_id'],
+                                        []).append(floating_ip)
+        host_uuids = {}
+        for port in ports:
+            if port.get('binding:host_id'):
+                host_uuids.setdefault(port['binding:host_id'],
+                                      set()).add(port['device_id'])
+        queue = Queue.Queue()
+        for host in sorted(host_uuids):
+            queue.put(host)
+        LOG.info("Scan %d ports of %d instances on %d hosts" % (
+            len(ports), len(uuids), queue.qsize()))
+        hosts = {}
+        workers = [threading.Thread(target=self._scan_host,
+                                    args=(queue, host_uuids, hosts))
+                   for _ in range(min(self._concurrency, queue.qsize()))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        for port in ports:
+            host = port.get('binding:host_id')
+            state = hosts.get(host, dict(snapshot=None, servers={},
+                                         error=None))
+            if host and state['error'] is not None:
+                # host not reachable, a reset would not help either
+                report[port['device_id']][port['id']] = None
+                continue
+            problems = self._check_port(
+                port, floating_ips.get(port['id'], []),
+                state['servers'].get(port['device_id']), state['snapshot'])
+            if not host:
+                problems.append("not bound to a host")
+            report[port['device_id']][port['id']] = problems
+        return report
+
+
+def broken_ports(report):
+    """Return {uuid: [port_id]} of the ports with a problem."""
+    broken = {}
+    for uuid, ports in report.items():
+        port_ids = [port_id for port_id, problems in ports.items()
+                    if problems]
+        if port_ids:
+            broken[uuid] = port_ids
+    return broken
+
+
+def print_scan(report):
+    """Print problems of broken ports and ports which were not checked."""
+    healthy = 0
+    for uuid in sorted(report):
+        for port_id, problems in sorted(report[uuid].items()):
+            if problems is None:
+                print("%s %s: not checked" % (uuid, port_id))
+            elif problems:
+                print("%s %s: %s" % (uuid, port_id, ", ".join(problems)))
+            else:
+                healthy += 1
+    broken = broken_ports(report)
+    print("[%d] instances scanned, %d ports healthy, %d ports broken on %d "
+          "instances" % (len(report), healthy,
+                         sum(len(ports) for ports in broken.values()),
+                         len(broken)))
+
+
+class NovaInterfaceBatchResetter(object):
+    """Reset many instances with a global and a per host concurrency."""
+
+    def __init__(self, concurrency=4, per_host=2, **args):
+        """Init NovaInterfaceBatchResetter."""
+        self._concurrency = concurrency
+        self._per_host = per_host
+        self._args = args
+        self._neutron = neutron_client.Client(**dict(
+            (k, v) for k, v in args.items() if k not in RESETTER_OPTIONS))
+        self.topology = TopologyCache(self._neutron)
+        self._local = threading.local()
+        self._cond = threading.Condition()
+
+    def _resetter(self):
+        # clients are not thread safe, each worker owns its resetter
+        if not hasattr(self._local, 'resetter'):
+            self._local.resetter = NovaInterfaceResetter(**deepcopy(self._args))
+        return self._local.resetter
+
+    def _instance_hosts(self, ports):
+        hosts = {}
+        for port in ports:
+            if not port['device_owner'].startswith('compute:'):
+                continue
+            hosts[port['device_id']] = port.get('binding:host_id')
+        return hosts
+
+    def instances(self, uuids=None, host=None, network_id=None):
+        """Return {uuid: host} of selected instances, with one api call."""
+        query = {}
+        if uuids:
+            query['device_id'] = list(uuids)
+        if host:
+            query['binding:host_id'] = host
+        if network_id:
+            query['network_id'] = network_id
+        if not query:
+            return {}
+        ports = self._neutron.list_ports(**query).get('ports', [])
+        if uuids and not (host or network_id):
+            # all ports of these instances, a later scan needs no listing
+            self.topology.add_ports(ports, uuids)
+        hosts = self._instance_hosts(ports)
+        for uuid in uuids or []:
+            hosts.setdefault(uuid, None)
+        return hosts
+
+    def scan(self, uuids):
+        """Health scan the ports of instances, see PortHealthScanner."""
+        args = dict((k, v) for k, v in self._args.items()
+                    if k not in RESETTER_OPTIONS)
+        scanner = PortHealthScanner(self._neutron,
+                                    lambda: nova_from_args(args),
+                                    concurrency=self._concurrency,
+                                    topology=self.topology)
+        return scanner.scan(uuids)
+
+    def _take(self, pending, running):
+        """Pick the next instance whose host has a free slot."""
+        with self._cond:
+            while pending:
+                for i, (uuid, host) in enumerate(pending):
+                    if running.get(host, 0) < self._per_host:
+                        running[host] = running.get(host, 0) + 1
+                        return pending.pop(i)
+                self._cond.wait()
+            return None
+
+    def _release(self, host, running):
+        with self._cond:
+            running[host] -= 1
+            self._cond.notify_all()
+
+    def _work(self, pending, running, results, port_ids):
+        while True:
+            item = self._take(pending, running)
+            if item is None:
+                return
+            uuid, host = item
+            result = dict(uuid=uuid, host=host, ports=[], error=None)
+            start_time = time.time()
+            try:
+                result['ports'] = self._resetter().reset_instance(
+                    uuid, port_ids.get(uuid))
+                result['status'] = 'done'
+            except Exception as e:
+                LOG.exception("Reset instance %s failed" % uuid)
+                result['status'] = 'failed'
+                result['error'] = str(e)
+            finally:
+                result['elapsed'] = time.time() - start_time
+                self._release(host, running)
+            results.append(result)
+
+    def reset_instances(self, instances, port_ids=None):
+        """Reset {uuid: host} instances, return a result of each instance.
+
+        port_ids {uuid: [port_id]} limits the ports reset on an instance.
+        """
+        port_ids = port_ids or {}
+        pending = sorted(instances.items())
+        running = {}
+        results = []
+        LOG.info("Reset %d instances, concurrency %d, %d per host" % (
+            len(pending), self._concurrency, self._per_host))
+        workers = [threading.Thread(target=self._work,
+                                    args=(pending, running, results,
+                                          port_ids))
+                   for _ in range(min(self._concurrency, len(pending)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
+
+def print_results(results):
+    """Print a result table of instances and downtime of each port."""
+    row = "%-36s  %-20s  %-6s  %8s  %s"
+    print(row % ('instance', 'host', 'status', 'elapsed', 'ports downtime'))
+    for result in sorted(results, key=lambda result: result['uuid']):
+        downtime = ", ".join("%s:%.2fs" % (port['port_id'][:8],
+                                           port['downtime'])
+                             for port in result['ports'])
+        print(row % (result['uuid'], result['host'], result['status'],
+                     "%.2fs" % result['elapsed'],
+                     downtime or result['error'] or '-'))
 
 
 if __name__ == '__main__':
@@ -149,11 +592,27 @@ if __name__ == '__main__':
             exit(1)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("uuid", help="instance uuid")
+    parser.add_argument("uuid", nargs='*', help="instance uuid")
     parser.add_argument('-k', '--insecure', action='store_true',
                         default=False, help='allow connections to SSL sites '
                                             'without certs')
+    parser.add_argument("--prestage", action='store_true', default=False,
+                        help="prepare replacement before detaching old port "
+                             "to shrink the downtime window")
+    parser.add_argument("--host", help="reset all instances on compute host")
+    parser.add_argument("--network",
+                        help="reset all instances with a port on network")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="max instances reset at the same time")
+    parser.add_argument("--per-host", type=int, default=2,
+                        help="max instances reset at the same time on one "
+                             "host")
+    parser.add_argument("--scan", action='store_true', default=False,
+                        help="only reset ports found broken by a health "
+                             "scan")
     args = parser.parse_args()
+    if not (args.uuid or args.host or args.network):
+        parser.error("uuid, --host or --network is required")
 
     os_args = dict(auth_url=os.environ.get('OS_AUTH_URL'),
                    username=os.environ.get('OS_USERNAME'),
@@ -161,7 +620,22 @@ if __name__ == '__main__':
                    password=os.environ.get('OS_PASSWORD'),
                    endpoint_type=os.environ.get('OS_ENDPOINT_TYPE',
                                                 'publicURL'),
-                   insecure=args.insecure)
+                   insecure=args.insecure,
+                   prestage=args.prestage)
 
-    resetter = NovaInterfaceResetter(**os_args)
-    resetter.reset_instance(args.uuid)
+    if len(args.uuid) == 1 and not (args.host or args.network or args.scan):
+        resetter = NovaInterfaceResetter(**os_args)
+        resetter.reset_instance(args.uuid[0])
+    else:
+        batch = NovaInterfaceBatchResetter(concurrency=args.concurrency,
+                                           per_host=args.per_host, **os_args)
+        instances = batch.instances(uuids=args.uuid, host=args.host,
+                                    network_id=args.network)
+        port_ids = None
+        if args.scan:
+            report = batch.scan(instances)
+            print_scan(report)
+            port_ids = broken_ports(report)
+            instances = dict((uuid, host) for uuid, host in instances.items()
+                             if uuid in port_ids)
+        print_results(batch.reset_instances(instances, port_ids))
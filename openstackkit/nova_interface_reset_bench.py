@@ -0,0 +1,376 @@
+#! /usr/bin/env python
+# This script will benchmark NovaInterfaceResetter against in process fake
+# nova and neutron clients. The fakes model api latency, nova detach and
+# attach, port creation and floating ip binding delays, and can inject
+# failures into any api call. It reports the total time, percentiles of the
+# per port downtime and the number of api calls.
+#
+# usage: nova_interface_reset_bench.py [-h] [--instances N] [--ports N]
+#                                      [--floating-ips N] [--concurrency N]
+#                                      [--prestage] [--wait-interval SECONDS]
+#                                      [--wait-timeout SECONDS] [--scale X]
+#                                      [--latency NAME=SECONDS]
+#                                      [--fail METHOD=RATE] [--seed N] [-d]
+# optional arguments:
+#   -h, --help              show this help message and exit
+#   --instances N           number of synthetic instances
+#   --ports N               ports of each instance
+#   --floating-ips N        floating ips of each port
+#   --concurrency N         instances reset at the same time
+#   --prestage              prepare replacement before detaching old port
+#   --wait-interval SECONDS poll interval of the resetter
+#   --wait-timeout SECONDS  poll timeout of the resetter
+#   --scale X               multiply all modeled latencies by X
+#   --latency NAME=SECONDS  override a modeled latency, can be repeated
+#   --fail METHOD=RATE      fail METHOD calls with probability RATE, can be
+#                           repeated
+#   --seed N                seed of latency jitter and failures
+#   -d, --debug             show the resetter log
+#
+import argparse
+import collections
+from copy import deepcopy
+import logging
+import Queue
+import random
+import threading
+import time
+import uuid
+
+from nova_interface_reset import NovaInterfaceResetter
+
+logging.basicConfig(level=logging.INFO, date_fmt='%m-%d %H:%M')
+LOG = logging.getLogger('nova-interface-reset-bench')
+
+# seconds, each delay is drawn from 50% to 150% of the value
+LATENCIES = {
+    'api': 0.05,         # any neutron or nova api call
+    'create_port': 0.3,  # neutron create_port call
+    'detach': 1.0,       # nova unbinds the port after interface_detach
+    'attach': 1.5,       # nova binds the port after interface_attach
+    'fip_bind': 1.0,     # l3 agent applies a floating ip change
+}
+
+
+class FakeCloud(object):
+    """Shared state, latency model and failures of the fake clients."""
+
+    def __init__(self, latencies=None, failures=None, scale=1.0, seed=0):
+        self.latencies = dict(LATENCIES, **(latencies or {}))
+        self.failures = failures or {}
+        self.scale = scale
+        self.lock = threading.RLock()
+        self.calls = collections.Counter()
+        self.ports = {}
+        self.floatingips = {}
+        self.servers = {}
+        self._random = random.Random(seed)
+        self._address = 0
+        self._timers = []
+
+    def delay(self, name):
+        with self.lock:
+            jitter = self._random.uniform(0.5, 1.5)
+        return self.latencies.get(name, 0) * jitter * self.scale
+
+    def call(self, method, latency='api'):
+        """Count an api call, wait its latency and maybe fail it."""
+        with self.lock:
+            self.calls[method] += 1
+            failed = self._random.random() < self.failures.get(method, 0)
+        time.sleep(self.delay(latency))
+        if failed:
+            raise Exception("Injected failure in %s" % method)
+
+    def later(self, name, func, *args):
+        """Apply a change after the modeled delay of name."""
+        def apply():
+            with self.lock:
+                func(*args)
+        timer = threading.Timer(self.delay(name), apply)
+        timer.daemon = True
+        with self.lock:
+            self._timers = [one for one in self._timers if one.is_alive()]
+            self._timers.append(timer)
+        timer.start()
+
+    def stop(self):
+        """Drop changes not applied yet."""
+        with self.lock:
+            timers, self._timers = self._timers, []
+        for timer in timers:
+            timer.cancel()
+            timer.join()
+
+    def address(self, prefix):
+        with self.lock:
+            self._address += 1
+            return "%s.%d.%d" % (prefix, self._address // 250,
+                                 self._address % 250 + 1)
+
+    def populate(self, instances, ports, floating_ips, host='compute-0'):
+        """Create instances with ports and floating ips, return uuids."""
+        uuids = []
+        for _ in range(instances):
+            server_id = str(uuid.uuid4())
+            self.servers[server_id] = host
+            uuids.append(server_id)
+            for _ in range(ports):
+                port = dict(id=str(uuid.uuid4()), device_id=server_id,
+                            device_owner='compute:nova', network_id='net',
+                            mac_address='fa:16:3e:00:00:00',
+                            fixed_ips=[dict(subnet_id='subnet',
+                                            ip_address=self.address('10'))],
+                            admin_state_up=True, tenant_id='tenant', name='',
+                            security_groups=['default'], status='ACTIVE')
+                port['binding:host_id'] = host
+                self.ports[port['id']] = port
+                for _ in range(floating_ips):
+                    floating_ip = dict(
+                        id=str(uuid.uuid4()), port_id=port['id'],
+                        status='ACTIVE',
+                        fixed_ip_address=port['fixed_ips'][0]['ip_address'],
+                        floating_ip_address=self.address('172'))
+                    self.floatingips[floating_ip['id']] = floating_ip
+        return uuids
+
+
+def _match(item, query):
+    for key, value in query.items():
+        values = value if isinstance(value, list) else [value]
+        if item.get(key) not in values:
+            return False
+    return True
+
+
+class FakeNeutron(object):
+    """Neutron client calls used by the resetter."""
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def list_ports(self, **query):
+        self._cloud.call('list_ports')
+        with self._cloud.lock:
+            return {'ports': [deepcopy(port)
+                              for port in self._cloud.ports.values()
+                              if _match(port, query)]}
+
+    def show_port(self, port_id):
+        self._cloud.call('show_port')
+        with self._cloud.lock:
+            if port_id not in self._cloud.ports:
+                raise Exception("Port %s could not be found" % port_id)
+            return {'port': deepcopy(self._cloud.ports[port_id])}
+
+    def create_port(self, body):
+        self._cloud.call('create_port', 'create_port')
+        port = deepcopy(body['port'])
+        port.update(id=str(uuid.uuid4()), device_id='', device_owner='',
+                    status='DOWN')
+        port['binding:host_id'] = ''
+        with self._cloud.lock:
+            self._cloud.ports[port['id']] = port
+            return {'port': deepcopy(port)}
+
+    def delete_port(self, port_id):
+        self._cloud.call('delete_port')
+        with self._cloud.lock:
+            self._cloud.ports.pop(port_id, None)
+            for floating_ip in self._cloud.floatingips.values():
+                if floating_ip['port_id'] == port_id:
+                    floating_ip.update(port_id=None, fixed_ip_address=None,
+                                       status='DOWN')
+
+    def list_floatingips(self, **query):
+        self._cloud.call('list_floatingips')
+        with self._cloud.lock:
+            return {'floatingips': [
+                deepcopy(floating_ip)
+                for floating_ip in self._cloud.floatingips.values()
+                if _match(floating_ip, query)]}
+
+    def _floatingip_status(self, floatingip_id, port_id):
+        floating_ip = self._cloud.floatingips[floatingip_id]
+        if floating_ip['port_id'] == port_id:
+            floating_ip['status'] = 'ACTIVE' if port_id else 'DOWN'
+
+    def update_floatingip(self, floatingip_id, body):
+        self._cloud.call('update_floatingip')
+        port_id = body['floatingip']['port_id']
+        with self._cloud.lock:
+            floating_ip = self._cloud.floatingips[floatingip_id]
+            fixed_ip = None
+            if port_id:
+                fixed_ip = self._cloud.ports[port_id][
+                    'fixed_ips'][0]['ip_address']
+            floating_ip.update(port_id=port_id, fixed_ip_address=fixed_ip)
+            updated = deepcopy(floating_ip)
+        # the status follows once the l3 agent applied the change
+        self._cloud.later('fip_bind', self._floatingip_status,
+                          floatingip_id, port_id)
+        return {'floatingip': updated}
+
+
+class FakeServer(object):
+    """Nova server calls used by the resetter."""
+
+    def __init__(self, cloud, server_id):
+        self._cloud = cloud
+        self.id = server_id
+
+    def to_dict(self):
+        return {'id': self.id, 'status': 'ACTIVE'}
+
+    def _unbind(self, port_id):
+        port = self._cloud.ports.get(port_id)
+        if port is not None:
+            port.update(device_id='', device_owner='', status='DOWN')
+            port['binding:host_id'] = ''
+
+    def _bind(self, port_id):
+        port = self._cloud.ports.get(port_id)
+        if port is not None:
+            port.update(device_id=self.id, device_owner='compute:nova',
+                        status='ACTIVE')
+            port['binding:host_id'] = self._cloud.servers[self.id]
+
+    def interface_detach(self, port_id):
+        self._cloud.call('interface_detach')
+        self._cloud.later('detach', self._unbind, port_id)
+
+    def interface_attach(self, port_id, net_id, fixed_ip):
+        self._cloud.call('interface_attach')
+        self._cloud.later('attach', self._bind, port_id)
+
+
+class FakeServers(object):
+
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def get(self, server_id):
+        self._cloud.call('servers.get')
+        if server_id not in self._cloud.servers:
+            raise Exception("Instance %s could not be found" % server_id)
+        return FakeServer(self._cloud, server_id)
+
+
+class FakeNova(object):
+
+    def __init__(self, cloud):
+        self.servers = FakeServers(cloud)
+
+
+def _work(cloud, queue, options, results):
+    resetter = NovaInterfaceResetter(neutron=FakeNeutron(cloud),
+                                     nova=FakeNova(cloud), **options)
+    while True:
+        try:
+            server_id = queue.get_nowait()
+        except Queue.Empty:
+            return
+        result = dict(uuid=server_id, ports=[], error=None)
+        try:
+            result['ports'] = resetter.reset_instance(server_id)
+        except Exception as e:
+            result['error'] = str(e)
+        results.append(result)
+
+
+def run(cloud, uuids, concurrency=1, **options):
+    """Reset instances, return (results, total seconds)."""
+    queue = Queue.Queue()
+    for server_id in uuids:
+        queue.put(server_id)
+    results = []
+    workers = [threading.Thread(target=_work,
+                                args=(cloud, queue, options, results))
+               for _ in range(min(concurrency, len(uuids)))]
+    start_time = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (results, time.time() - start_time)
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def print_report(results, elapsed, calls):
+    """Print total time, port downtime percentiles and api call counts."""
+    ports = [port for result in results for port in result['ports']]
+    failed = [result for result in results if result['error']]
+    print("[%d] instances, %d ports reset, %d instances failed in %.2f "
+          "seconds" % (len(results), len(ports), len(failed), elapsed))
+    for name in ('downtime', 'elapsed'):
+        values = [port[name] for port in ports]
+        print("port %-8s p50 %.2fs p90 %.2fs p99 %.2fs max %.2fs" % (
+            name, percentile(values, 50), percentile(values, 90),
+            percentile(values, 99), max(values or [0.0])))
+    print("api calls %d" % sum(calls.values()))
+    for method, count in sorted(calls.items()):
+        print("  %-20s %d" % (method, count))
+    for result in failed:
+        print("failed %s - %s" % (result['uuid'], result['error']))
+
+
+def name_value(option):
+    name, sep, value = option.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError("expected NAME=VALUE: %s" % option)
+    return (name, float(value))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instances", type=int, default=10,
+                        help="number of synthetic instances")
+    parser.add_argument("--ports", type=int, default=2,
+                        help="ports of each instance")
+    parser.add_argument("--floating-ips", type=int, default=1,
+                        help="floating ips of each port")
+    parser.add_argument("--concurrency", type=int, default=10,
+                        help="instances reset at the same time")
+    parser.add_argument("--prestage", action='store_true', default=False,
+                        help="prepare replacement before detaching old port")
+    parser.add_argument("--wait-interval", type=float, default=0.5,
+                        help="poll interval of the resetter")
+    parser.add_argument("--wait-timeout", type=float, default=20,
+                        help="poll timeout of the resetter")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply all modeled latencies")
+    parser.add_argument("--latency", type=name_value, action='append',
+                        default=[], help="override a modeled latency, one "
+                                         "of: %s" % ", ".join(sorted(LATENCIES)))
+    parser.add_argument("--fail", type=name_value, action='append',
+                        default=[], help="fail METHOD calls with probability "
+                                         "RATE")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of latency jitter and failures")
+    parser.add_argument('-d', '--debug', action='store_true', default=False,
+                        help='show the resetter log')
+    args = parser.parse_args()
+
+    if not args.debug:
+        logging.getLogger('nova-interface-reset').setLevel(logging.WARNING)
+    cloud = FakeCloud(latencies=dict(args.latency),
+                      failures=dict(args.fail), scale=args.scale,
+                      seed=args.seed)
+    uuids = cloud.populate(args.instances, args.ports, args.floating_ips)
+    LOG.info("Reset %d instances with %d ports and %d floating ips each, "
+             "concurrency %d" % (args.instances, args.ports,
+                                 args.floating_ips, args.concurrency))
+    results, elapsed = run(cloud, uuids, args.concurrency,
+                           prestage=args.prestage,
+                           wait_interval=args.wait_interval,
+                           wait_timeout=args.wait_timeout)
+    cloud.stop()
+    print_report(results, elapsed, cloud.calls)
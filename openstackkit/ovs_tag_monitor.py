@@ -0,0 +1,314 @@
+#! /usr/bin/env python
+# This script will watch the ovsdb Port and Interface tables through an
+# `ovsdb-client monitor` change stream, and report qvo ports which stay
+# without a local vlan tag. The stream may come from a live ovsdb-client,
+# over ssh, or from a recorded file for replay.
+#
+# usage: ovs_tag_monitor.py [-h] [-k] [--host HOST] [--replay FILE]
+#                           [--grace SECONDS] [--fix]
+# optional arguments:
+#   -h, --help       show this help message and exit
+#   -k, --insecure   allow connections to SSL sites without certs
+#   --host HOST      monitor ovsdb of HOST over ssh, default local
+#   --replay FILE    read a recorded monitor stream from FILE
+#   --grace SECONDS  time left to ovs agent to tag a new port
+#   --fix            set the missing tag with qvo_tag_add
+#
+import argparse
+import json
+import logging
+import os
+import Queue
+import select
+import subprocess
+import sys
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO, date_fmt='%m-%d %H:%M')
+LOG = logging.getLogger('ovs-tag-monitor')
+
+MONITOR_CMD = ["ovsdb-client", "--format=json", "monitor", "Open_vSwitch",
+               "Port", "name,tag", "Interface", "name,external_ids"]
+
+
+def ovsdb_value(value):
+    """Convert an ovsdb json value to python."""
+    if isinstance(value, list) and len(value) == 2:
+        kind, data = value
+        if kind == 'set':
+            return [ovsdb_value(one) for one in data]
+        if kind == 'map':
+            return dict((key, ovsdb_value(one)) for key, one in data)
+        if kind == 'uuid':
+            return data
+    return value
+
+
+class OvsdbIndex(object):
+    """In memory rows of monitored tables, indexed by uuid and name."""
+
+    def __init__(self):
+        self.rows = {}
+        self.names = {}
+
+    def table(self, name):
+        return self.rows.setdefault(name, {})
+
+    def get(self, table, name):
+        uuid = self.names.get(table, {}).get(name)
+        if uuid is None:
+            return None
+        return self.rows[table].get(uuid)
+
+    def update(self, table, uuid, action, row):
+        """Apply one row change, return the current row or None."""
+        rows = self.table(table)
+        names = self.names.setdefault(table, {})
+        if action == 'delete':
+            row = rows.pop(uuid, None)
+            if row is not None:
+                names.pop(row.get('name'), None)
+            return None
+        if action == 'old':
+            # the old values of a modified row, the new row follows
+            return rows.get(uuid)
+        current = rows.setdefault(uuid, {})
+        if current.get('name') is not None and \
+                current.get('name') != row.get('name', current['name']):
+            names.pop(current['name'], None)
+        current.update(row)
+        if current.get('name') is not None:
+            names[current['name']] = uuid
+        return current
+
+
+class QvoTagDetector(object):
+    """Report qvo ports which are still untagged after grace seconds.
+
+    A port whose Interface row has no iface-id yet, which comes on a later
+    line of the same transaction, is reported up to iface_wait seconds
+    later to give the row time to arrive.
+    """
+
+    def __init__(self, on_untagged, grace=0, prefix='qvo', clock=time.time,
+                 iface_wait=1.0):
+        self._on_untagged = on_untagged
+        self._grace = grace
+        self._prefix = prefix
+        self._clock = clock
+        self._iface_wait = iface_wait
+        self.index = OvsdbIndex()
+        self.pending = {}
+        self._deferred = set()
+
+    def _table(self, update):
+        caption = update.get('caption', '')
+        if caption.endswith(' table'):
+            return caption[:-len(' table')]
+        return 'Port'
+
+    def feed(self, line):
+        """Apply one line of the monitor stream."""
+        line = line.strip()
+        if not line.startswith('{'):
+            return
+        update = json.loads(line)
+        table = self._table(update)
+        headings = update.get('headings', [])
+        old_uuid = None
+        for data in update.get('data', []):
+            values = dict(zip(headings, data))
+            uuid = values.pop('row')
+            action = values.pop('action')
+            # the new row of a modify has an empty uuid, it is the one of
+            # the old row just before
+            if action == 'old':
+                old_uuid = uuid
+            elif action == 'new' and not uuid:
+                uuid = old_uuid
+            row = dict((column, ovsdb_value(value))
+                       for column, value in values.items())
+            current = self.index.update(table, uuid, action, row)
+            if table == 'Port':
+                self._check_port(uuid, current)
+            elif table == 'Interface' and current:
+                self._interface_seen(current)
+        self.check()
+
+    def _interface_seen(self, interface):
+        # a deferred port is reported as soon as its iface-id is known
+        uuid = self.index.names.get('Port', {}).get(interface.get('name'))
+        if uuid in self._deferred and uuid in self.pending and \
+                interface.get('external_ids', {}).get('iface-id'):
+            self.pending[uuid] = min(self.pending[uuid], self._clock())
+
+    def _check_port(self, uuid, port):
+        if port is None:
+            self.pending.pop(uuid, None)
+            self._deferred.discard(uuid)
+            return
+        if not port.get('name', '').startswith(self._prefix):
+            return
+        if port.get('tag') in (None, []):
+            self.pending.setdefault(uuid, self._clock() + self._grace)
+        else:
+            self.pending.pop(uuid, None)
+            self._deferred.discard(uuid)
+
+    def check(self, force=False):
+        """Report pending ports whose grace period is over."""
+        now = self._clock()
+        for uuid, deadline in sorted(self.pending.items(),
+                                     key=lambda item: item[1]):
+            if deadline > now:
+                continue
+            port = self.index.table('Port')[uuid]
+            interface = self.index.get('Interface', port['name']) or {}
+            port_id = interface.get('external_ids', {}).get('iface-id')
+            if not port_id and not force and uuid not in self._deferred:
+                self._deferred.add(uuid)
+                self.pending[uuid] = now + self._iface_wait
+                continue
+            del self.pending[uuid]
+            self._deferred.discard(uuid)
+            self._on_untagged(port['name'], port_id)
+
+    def next_deadline(self):
+        if not self.pending:
+            return None
+        return min(self.pending.values())
+
+    def flush(self):
+        """Report all pending ports, used when a recorded stream ends."""
+        for uuid in list(self.pending):
+            self.pending[uuid] = 0
+        self.check(force=True)
+
+    def run(self, stream):
+        """Consume the stream until it ends."""
+        if not hasattr(stream, 'fileno'):
+            for line in stream:
+                self.feed(line)
+            return
+        # read the fd directly, select does not see lines already buffered
+        # by the file object
+        fd = stream.fileno()
+        buf = ''
+        while True:
+            deadline = self.next_deadline()
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - self._clock(), 0)
+            readable, _, _ = select.select([fd], [], [], timeout)
+            if not readable:
+                self.check()
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            lines = (buf + data).split('\n')
+            buf = lines.pop()
+            for line in lines:
+                self.feed(line)
+        if buf:
+            self.feed(buf)
+
+
+def log_untagged(name, port_id):
+    LOG.warning("Port %s of neutron port %s has no tag" % (name, port_id))
+
+
+class Worker(object):
+    """Run a callback in a thread, so the stream is never blocked by it."""
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._queue = Queue.Queue()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            try:
+                self._callback(*args)
+            except Exception:
+                LOG.exception("Failed to handle %s" % (args,))
+            finally:
+                self._queue.task_done()
+
+    def __call__(self, *args):
+        self._queue.put(args)
+
+    def join(self):
+        """Wait until all queued calls are done."""
+        self._queue.join()
+
+
+class QvoTagFixer(object):
+    """Set the missing tag of a reported port with qvo_tag_add."""
+
+    def __init__(self, neutron, host):
+        from qvo_tag_add import QvoTagger
+        self._neutron = neutron
+        self._tagger = QvoTagger(neutron)
+        self._host = host
+
+    def __call__(self, name, port_id):
+        log_untagged(name, port_id)
+        if not port_id:
+            return
+        ports = self._neutron.list_ports(id=port_id).get('ports', [])
+        if not ports:
+            return
+        segmentation_ids = self._tagger.segmentation_ids(
+            [ports[0]['network_id']])
+        self._tagger.repair_host(self._host or ports[0]['binding:host_id'],
+                                 ports, segmentation_ids)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', '--insecure', action='store_true',
+                        default=False, help='allow connections to SSL sites '
+                                            'without certs')
+    parser.add_argument("--host", help="monitor ovsdb of host over ssh")
+    parser.add_argument("--replay", help="read a recorded monitor stream")
+    parser.add_argument("--grace", type=float, default=3,
+                        help="time left to ovs agent to tag a new port")
+    parser.add_argument("--fix", action='store_true', default=False,
+                        help="set the missing tag with qvo_tag_add")
+    args = parser.parse_args()
+
+    on_untagged = log_untagged
+    if args.fix:
+        from neutronclient.v2_0 import client as neutron_client
+        neutron = neutron_client.Client(
+            auth_url=os.environ.get('OS_AUTH_URL'),
+            username=os.environ.get('OS_USERNAME'),
+            tenant_name=os.environ.get('OS_TENANT_NAME'),
+            password=os.environ.get('OS_PASSWORD'),
+            endpoint_type=os.environ.get('OS_ENDPOINT_TYPE', 'publicURL'),
+            insecure=args.insecure)
+        on_untagged = QvoTagFixer(neutron, args.host)
+
+    # fixes take ssh round trips, run them off the stream loop
+    worker = Worker(on_untagged)
+    detector = QvoTagDetector(worker, grace=args.grace)
+    if args.replay:
+        with open(args.replay) as stream:
+            detector.run(stream)
+        detector.flush()
+        worker.join()
+        sys.exit(0)
+    cmd = MONITOR_CMD
+    if args.host:
+        cmd = ["ssh", "-o", "BatchMode=yes", args.host, " ".join(cmd)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        detector.run(proc.stdout)
+    except KeyboardInterrupt:
+        proc.terminate()
+    sys.exit(proc.wait())
@@ -1,5 +1,6 @@
 #! /usr/bin/python
 # @author: wtie
+import os
 import subprocess
 import sys
 import time
@@ -7,6 +8,8 @@ import argparse
 
 DIFF = False
 FIRST = []
+PROBE_LOG = None
+DEVNULL = open(os.devnull, 'w')
 
 
 def get_floating_ips():
@@ -77,9 +80,13 @@ AND    i.count=1;"""
     return public_ips
 
 
+def ping_async(ip, deadline=1):
+    return subprocess.Popen(["ping", "-c", "1", "-w", str(deadline), ip],
+                            stdout=DEVNULL, stderr=DEVNULL)
+
+
 def ping(ip):
-    return subprocess.call(["ping", "-c", "1", "-w", "1", ip],
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return ping_async(ip).wait()
 
 
 def ping_loop(net_uuid=None):
@@ -94,6 +101,8 @@ def ping_loop(net_uuid=None):
             result = "?"
         else:
             result = ping(ip)
+            if PROBE_LOG:
+                PROBE_LOG.record(ip, result)
         sys.stdout.write(str(result))
         sys.stdout.flush()
         if result == 1:
@@ -101,6 +110,8 @@ def ping_loop(net_uuid=None):
 
         #simple way to remove duplicate ips, need to improve
         fail_list = list(set(fail_list))
+    if PROBE_LOG:
+        PROBE_LOG.round()
     if DIFF:
         if FIRST:
             diff_list = [ip for ip in fail_list if ip not in FIRST]
@@ -136,12 +147,17 @@ if __name__ == '__main__':
     parser.add_argument("--diff", action="store_true",
                         help="Only print diff ips compare with first round",
                         default=False)
+    parser.add_argument("--log",
+                        help="Append probe results to binary probe log <log>")
     args = parser.parse_args()
 
     public_network_uuid = args.net_id if args.net_id else None
     least_interval = 10
     if args.diff:
         DIFF = True
+    if args.log:
+        from probe_log import ProbeLogWriter
+        PROBE_LOG = ProbeLogWriter(args.log)
     while True:
         try:
             start = time.time()
@@ -158,5 +174,7 @@ if __name__ == '__main__':
                 time.sleep(least_interval - (end-start))
         except KeyboardInterrupt:
             print_report(failed_map,least_interval)
+            if PROBE_LOG:
+                PROBE_LOG.close()
             sys.exit(0)
 
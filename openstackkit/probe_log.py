@@ -0,0 +1,368 @@
+#! /usr/bin/env python
+# @author: wtie
+# Compact append-only log of ping probe results.
+#
+# File layout (little endian):
+#   header   : magic(4s) version(H) capacity(H) count(H) pad(H) base_ms(Q)
+#   ip table : capacity * 4 bytes of packed IPv4 addresses
+#   records  : offset_ms(I) ip_index(H) result(B), 7 bytes each
+#
+# Only state changes are recorded for an ip, plus one ROUND marker per probe
+# round, so a day of sub-second probing of 10k ips stays in the low MB range.
+# Records are appended in time order, which lets the reader bisect on time.
+#
+# Every so many records a round ends with a checkpoint: a CHECKPOINT marker,
+# the last state of every ip and a ROUND marker, so a query only reads from
+# the checkpoint before its start. When offsets would overflow, about 49 days
+# after base_ms, the file is moved to <log>.<base_ms> and a new one starts
+# with a checkpoint of the current state.
+#
+# usage: probe_log.py [-h] [--ip IP] [--start T] [--end T] log
+import argparse
+import bisect
+import mmap
+import os
+import socket
+import struct
+import time
+
+MAGIC = b'PRBL'
+VERSION = 2
+VERSIONS = (1, 2)
+HEADER = struct.Struct('<4sHHHHQ')
+RECORD = struct.Struct('<IHB')
+IP_SIZE = 4
+MAX_CAPACITY = 0xFFFE
+MAX_OFFSET = 0xFFFFFFFF
+CHECKPOINT = 0xFFFE
+ROUND = 0xFFFF
+
+RESULT_UP = 0
+RESULT_DOWN = 1
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+class ProbeLogWriter(object):
+    """Append probe results to a probe log file."""
+
+    def __init__(self, path, ips=None, capacity=16384,
+                 checkpoint_records=65536, rotate_ms=MAX_OFFSET):
+        self._path = path
+        self._ips = []
+        self._index = {}
+        self._last = {}
+        self._checkpoint_records = checkpoint_records
+        self._rotate_ms = min(rotate_ms, MAX_OFFSET)
+        self._since_checkpoint = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._fd = open(path, 'r+b')
+            self._load()
+        else:
+            self._fd = open(path, 'w+b')
+            self._capacity = min(max(capacity, len(ips or [])), MAX_CAPACITY)
+            self._base_ms = _now_ms()
+            self._write_header()
+        for ip in ips or []:
+            self.index(ip)
+        self._fd.seek(0, os.SEEK_END)
+
+    def _load(self):
+        magic, version, capacity, count, _, base_ms = HEADER.unpack(
+            self._fd.read(HEADER.size))
+        if magic != MAGIC or version not in VERSIONS:
+            raise Exception("%s is not a probe log" % self._path)
+        self._capacity = capacity
+        self._base_ms = base_ms
+        table = self._fd.read(capacity * IP_SIZE)
+        for i in range(count):
+            self._add(socket.inet_ntoa(table[i * IP_SIZE:(i + 1) * IP_SIZE]))
+        # a record torn by a crash would misalign all the records after it
+        start = self._records_offset()
+        count = max(os.path.getsize(self._path) - start, 0) // RECORD.size
+        self._fd.truncate(start + count * RECORD.size)
+        # rebuild the last known state of each ip to keep change-only
+        # semantic across restarts, the last checkpoint holds all of it
+        self._fd.seek(start + self._last_checkpoint(start, count) *
+                      RECORD.size)
+        data = self._fd.read()
+        for position in range(0, len(data), RECORD.size):
+            _, index, result = RECORD.unpack_from(data, position)
+            self._since_checkpoint += 1
+            if index == CHECKPOINT:
+                self._since_checkpoint = 0
+            elif index != ROUND:
+                self._last[index] = result
+        # records appended from now on may hold checkpoints
+        self._write_count()
+
+    def _last_checkpoint(self, start, count, block=4096):
+        """Return the position of the last checkpoint, 0 if none."""
+        end = count
+        while end > 0:
+            first = max(end - block, 0)
+            self._fd.seek(start + first * RECORD.size)
+            data = self._fd.read((end - first) * RECORD.size)
+            for position in range(end - first - 1, -1, -1):
+                if RECORD.unpack_from(data, position * RECORD.size)[1] == \
+                        CHECKPOINT:
+                    return first + position
+            end = first
+        return 0
+
+    def _records_offset(self):
+        return HEADER.size + self._capacity * IP_SIZE
+
+    def _write_count(self):
+        self._fd.seek(0)
+        self._fd.write(HEADER.pack(MAGIC, VERSION, self._capacity,
+                                   len(self._ips), 0, self._base_ms))
+        self._fd.seek(0, os.SEEK_END)
+
+    def _write_header(self):
+        self._fd.seek(0)
+        self._fd.write(HEADER.pack(MAGIC, VERSION, self._capacity,
+                                   len(self._ips), 0, self._base_ms))
+        table = b''.join(socket.inet_aton(ip) for ip in self._ips)
+        self._fd.write(table.ljust(self._capacity * IP_SIZE, b'\0'))
+
+    def _add(self, ip):
+        self._index[ip] = len(self._ips)
+        self._ips.append(ip)
+        return self._index[ip]
+
+    def index(self, ip):
+        """Return the dictionary index of ip, registering it if needed."""
+        if ip in self._index:
+            return self._index[ip]
+        if len(self._ips) >= self._capacity:
+            raise Exception("Probe log %s is full, %d ips registered" %
+                            (self._path, self._capacity))
+        index = self._add(ip)
+        self._fd.seek(HEADER.size + index * IP_SIZE)
+        self._fd.write(socket.inet_aton(ip))
+        self._write_count()
+        return index
+
+    def _offset(self, timestamp):
+        if timestamp is None:
+            now_ms = _now_ms()
+        else:
+            now_ms = int(timestamp * 1000)
+        if now_ms - self._base_ms > self._rotate_ms:
+            self._rotate(now_ms)
+        return max(now_ms - self._base_ms, 0)
+
+    def _write(self, offset, index, result):
+        self._fd.write(RECORD.pack(offset, index, result))
+        self._since_checkpoint += 1
+
+    def _checkpoint(self, offset):
+        self._write(offset, CHECKPOINT, 0)
+        for index, result in sorted(self._last.items()):
+            self._write(offset, index, result)
+        self._write(offset, ROUND, 0)
+        self._since_checkpoint = 0
+
+    def _rotate(self, base_ms):
+        """Move the full file aside and go on in a new one."""
+        self._fd.close()
+        os.rename(self._path, "%s.%d" % (self._path, self._base_ms))
+        self._fd = open(self._path, 'w+b')
+        self._base_ms = base_ms
+        self._write_header()
+        self._fd.seek(0, os.SEEK_END)
+        # carry the state over, the new file is read on its own
+        self._checkpoint(0)
+
+    def _append(self, index, result, timestamp=None):
+        self._write(self._offset(timestamp), index, result)
+
+    def record(self, ip, result, timestamp=None):
+        """Record a probe result, only written when the ip changed state."""
+        index = self.index(ip)
+        result = RESULT_UP if result == RESULT_UP else RESULT_DOWN
+        if self._last.get(index) == result:
+            return False
+        self._last[index] = result
+        self._append(index, result, timestamp)
+        return True
+
+    def round(self, timestamp=None):
+        """Mark the end of a probe round and flush to disk."""
+        offset = self._offset(timestamp)
+        self._write(offset, ROUND, 0)
+        # a checkpoint costs a record per ip, keep it a small share
+        if self._since_checkpoint >= max(self._checkpoint_records,
+                                         4 * len(self._last)):
+            self._checkpoint(offset)
+        self._fd.flush()
+
+    def close(self):
+        self._fd.flush()
+        self._fd.close()
+
+
+class ProbeLogReader(object):
+    """Query a probe log through a read only memory map."""
+
+    def __init__(self, path):
+        self._fd = open(path, 'rb')
+        self._map = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, capacity, count, _, base_ms = HEADER.unpack_from(
+            self._map, 0)
+        if magic != MAGIC or version not in VERSIONS:
+            raise Exception("%s is not a probe log" % path)
+        self.base_time = base_ms / 1000.0
+        self._offset = HEADER.size + capacity * IP_SIZE
+        self.ips = []
+        for i in range(count):
+            start = HEADER.size + i * IP_SIZE
+            self.ips.append(socket.inet_ntoa(self._map[start:start + IP_SIZE]))
+        self._index = dict((ip, i) for i, ip in enumerate(self.ips))
+        self.length = (len(self._map) - self._offset) // RECORD.size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        return RECORD.unpack_from(self._map,
+                                  self._offset + position * RECORD.size)
+
+    def _time(self, offset_ms):
+        return self.base_time + offset_ms / 1000.0
+
+    def _position(self, timestamp):
+        # records are in time order, so bisect on a lazy view of offsets
+        if timestamp is None:
+            return self.length
+        offset_ms = int((timestamp - self.base_time) * 1000)
+        return bisect.bisect_left(_OffsetView(self), offset_ms)
+
+    def records(self, start=None, end=None):
+        """Yield (timestamp, ip, result) between start and end."""
+        first = self._position(start) if start is not None else 0
+        in_checkpoint = False
+        for position in range(first, self._position(end)):
+            offset_ms, index, result = self[position]
+            # states dumped by a checkpoint are not changes
+            if index == CHECKPOINT:
+                in_checkpoint = True
+                continue
+            if index == ROUND:
+                in_checkpoint = False
+                continue
+            if in_checkpoint:
+                continue
+            yield (self._time(offset_ms), self.ips[index], result)
+
+    @property
+    def end_time(self):
+        if self.length == 0:
+            return self.base_time
+        return self._time(self[self.length - 1][0])
+
+    def outages(self, ip):
+        """Return [(down_at, up_at)] for ip, up_at is None if still down."""
+        index = self._index.get(ip)
+        if index is None:
+            return []
+        intervals = []
+        down_at = None
+        for position in range(self.length):
+            offset_ms, one_index, result = self[position]
+            # a checkpoint repeats the state, which changes nothing here
+            if one_index != index:
+                continue
+            if result == RESULT_DOWN and down_at is None:
+                down_at = self._time(offset_ms)
+            elif result == RESULT_UP and down_at is not None:
+                intervals.append((down_at, self._time(offset_ms)))
+                down_at = None
+        if down_at is not None:
+            intervals.append((down_at, None))
+        return intervals
+
+    def down_between(self, start, end):
+        """Return ips which were down at any time between start and end."""
+        first = self._position(start)
+        last = self._position(end)
+        state = {}
+        down = set()
+        for position in range(self._checkpoint_before(first), last):
+            offset_ms, index, result = self[position]
+            if index in (ROUND, CHECKPOINT):
+                continue
+            if position < first:
+                state[index] = result
+            elif result == RESULT_DOWN:
+                down.add(index)
+        # ips already down at start are reported even without a new record
+        down.update(index for index, result in state.items()
+                    if result == RESULT_DOWN)
+        return sorted(self.ips[index] for index in down)
+
+    def _checkpoint_before(self, position):
+        """Return the position of the last checkpoint before position."""
+        for one in range(min(position, self.length) - 1, -1, -1):
+            if self[one][1] == CHECKPOINT:
+                return one
+        return 0
+
+    def close(self):
+        self._map.close()
+        self._fd.close()
+
+
+class _OffsetView(object):
+    """Sequence of record offsets, used by bisect without copying."""
+
+    def __init__(self, reader):
+        self._reader = reader
+
+    def __len__(self):
+        return len(self._reader)
+
+    def __getitem__(self, position):
+        return self._reader[position][0]
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return time.mktime(time.strptime(value, '%Y-%m-%d %H:%M:%S'))
+
+
+def _format_time(timestamp):
+    if timestamp is None:
+        return '-'
+    return time.strftime('%x %X', time.localtime(timestamp))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log", help="probe log file")
+    parser.add_argument("--ip", help="show outage intervals of <ip>")
+    parser.add_argument("--start", help="epoch or 'Y-m-d H:M:S'")
+    parser.add_argument("--end", help="epoch or 'Y-m-d H:M:S'")
+    args = parser.parse_args()
+
+    reader = ProbeLogReader(args.log)
+    if args.ip:
+        for down_at, up_at in reader.outages(args.ip):
+            duration = (up_at or reader.end_time) - down_at
+            print("%s - %s : %.1fs" % (_format_time(down_at),
+                                       _format_time(up_at), duration))
+    else:
+        start = _parse_time(args.start) or reader.base_time
+        end = _parse_time(args.end) or reader.end_time
+        down = reader.down_between(start, end)
+        print("%s/%s down between %s and %s: %s" % (
+            len(down), len(reader.ips), _format_time(start),
+            _format_time(end), down))
+    reader.close()
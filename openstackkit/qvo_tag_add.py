@@ -0,0 +1,284 @@
+#! /usr/bin/env python
+# This script will add the missing local vlan tag to qvo ports of an
+# instance, or of every compute host with --all, which happens when ovs agent
+# fails to finish the port setup. Neutron data is fetched in bulk and each
+# hypervisor is visited with one ssh call to snapshot ovs and one ssh call to
+# fix all its ports.
+#
+# usage: qvo_tag_add.py [-h] [-k] [--dry-run] [--all] [--concurrency N]
+#                       [uuid]
+# positional arguments:
+#   uuid             instance uuid
+# optional arguments:
+#   -h, --help       show this help message and exit
+#   -k, --insecure   allow connections to SSL sites without certs
+#   --dry-run        only show the ports need to be fixed
+#   --all            audit all compute hosts instead of one instance
+#   --concurrency N  max hosts audited at the same time
+#
+import argparse
+import logging
+import os
+import Queue
+import re
+import subprocess
+import threading
+
+from neutronclient.v2_0 import client as neutron_client
+from topology import TopologyCache
+
+logging.basicConfig(level=logging.INFO, date_fmt='%m-%d %H:%M')
+LOG = logging.getLogger('qvo-tag-add')
+
+SEPARATOR = '----8<----'
+SNAPSHOT_CMD = ("/usr/bin/ovs-vsctl --timeout=10 --format=csv --data=bare "
+                "--no-headings --columns=name,tag list Port; echo '%s'; "
+                "/usr/bin/ovs-ofctl dump-flows br-int; echo '%s'; "
+                "ls -1 /sys/class/net" % (SEPARATOR, SEPARATOR))
+LOCAL_VLAN = re.compile(r'dl_vlan=(\d+)\b.*actions=mod_vlan_vid:(\d+)')
+
+
+def ssh_exec(host, cmd):
+    proc = subprocess.Popen(["ssh", "-o", "BatchMode=yes", "-o",
+                             "ConnectTimeout=10", host, cmd],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    return (proc.returncode, stdout, stderr)
+
+
+def qvo_name(port_id):
+    return 'qvo' + port_id[0:11]
+
+
+def tap_name(port_id):
+    return 'tap' + port_id[0:11]
+
+
+class OvsSnapshot(object):
+    """Ports, tags, local vlans and net devices of one hypervisor."""
+
+    def __init__(self, tags, local_vlans, devices):
+        self.tags = tags
+        self.local_vlans = local_vlans
+        self.devices = devices
+
+    @classmethod
+    def parse(cls, output):
+        sections = (output.split(SEPARATOR) + ['', ''])[0:3]
+        ports, flows, devices = [section.strip() for section in sections]
+        tags = {}
+        for line in ports.splitlines():
+            name, _, tag = line.partition(',')
+            tags[name.strip('"')] = int(tag) if tag.strip() else None
+        local_vlans = {}
+        for line in flows.splitlines():
+            match = LOCAL_VLAN.search(line)
+            if match:
+                local_vlans[int(match.group(1))] = int(match.group(2))
+        return cls(tags, local_vlans, set(devices.split()))
+
+    def on_bridge(self, name):
+        return name in self.tags
+
+    def tag(self, name):
+        return self.tags.get(name)
+
+    def plugged(self, name):
+        return name in self.tags or name in self.devices
+
+
+class QvoTagger(object):
+    """QvoTagger."""
+
+    def __init__(self, neutron, remote_exec=ssh_exec, topology=None):
+        """Init QvoTagger."""
+        self._neutron = neutron
+        self._remote_exec = remote_exec
+        self._topology = topology or TopologyCache(neutron)
+
+    def segmentation_ids(self, network_ids=None):
+        """Return {network_id: segmentation_id} from the topology cache."""
+        return self._topology.segmentation_ids(network_ids)
+
+    def snapshot(self, host):
+        """Snapshot ovs ports, br-int flows and net devices of host."""
+        rc, stdout, stderr = self._remote_exec(host, SNAPSHOT_CMD)
+        if rc != 0:
+            raise Exception("Failed to snapshot ovs on host %s - %s" %
+                            (host, stderr))
+        return OvsSnapshot.parse(stdout)
+
+    def plan(self, ports, segmentation_ids, snapshot):
+        """Return [(port, qvo, tag)] to fix and [(port, reason)] ignored."""
+        fixes = []
+        ignored = []
+        for port in ports:
+            qvo = qvo_name(port['id'])
+            if not snapshot.on_bridge(qvo):
+                ignored.append((port, "qvo %s not on bridge" % qvo))
+                continue
+            if not snapshot.plugged(tap_name(port['id'])):
+                ignored.append((port, "tap not plugged"))
+                continue
+            if snapshot.tag(qvo) is not None:
+                ignored.append((port, "qvo %s has tag %s" %
+                                (qvo, snapshot.tag(qvo))))
+                continue
+            segmentation_id = segmentation_ids.get(port['network_id'])
+            tag = snapshot.local_vlans.get(segmentation_id)
+            if tag is None:
+                ignored.append((port, "no local vlan for segmentation id %s "
+                                "in br-int flows" % segmentation_id))
+                continue
+            fixes.append((port, qvo, tag))
+        return (fixes, ignored)
+
+    def apply(self, host, fixes):
+        """Set all missing tags of host in one ovs-vsctl transaction."""
+        if not fixes:
+            return True
+        cmd = "/usr/bin/ovs-vsctl --timeout=10 " + " -- ".join(
+            "set Port %s tag=%d" % (qvo, tag) for _, qvo, tag in fixes)
+        rc, stdout, stderr = self._remote_exec(host, cmd)
+        if rc != 0:
+            LOG.error("Failed to set tags on host %s - %s" % (host, stderr))
+            return False
+        return True
+
+    def repair_host(self, host, ports, segmentation_ids, dry_run=False):
+        """Fix ports on one host, return the ports fixed."""
+        fixes, ignored = self.plan(ports, segmentation_ids,
+                                   self.snapshot(host))
+        for port, reason in ignored:
+            LOG.debug("Ignored port %s on host %s because %s" % (
+                port['id'], host, reason))
+        for port, qvo, tag in fixes:
+            LOG.info("%s port %s on host %s - set %s tag=%d" % (
+                "Found" if dry_run else "Fix", port['id'], host, qvo, tag))
+        if dry_run or self.apply(host, fixes):
+            return [port for port, _, _ in fixes]
+        return []
+
+    def repair_instance(self, uuid, dry_run=False):
+        """Fix qvo ports of an instance, return the ports fixed."""
+        ports = self._topology.device_ports([uuid])[uuid]
+        LOG.info("Check %d ports for instance %s" % (len(ports), uuid))
+        segmentation_ids = self.segmentation_ids(
+            set(port['network_id'] for port in ports))
+        hosts = {}
+        for port in ports:
+            if not port.get('binding:host_id'):
+                LOG.info("Ignored port %s of instance %s because it is not "
+                         "bound to a host" % (port['id'], uuid))
+                continue
+            hosts.setdefault(port['binding:host_id'], []).append(port)
+        fixed = []
+        for host, host_ports in hosts.items():
+            fixed += self.repair_host(host, host_ports, segmentation_ids,
+                                      dry_run)
+        return fixed
+
+    def compute_hosts(self):
+        """Return hosts running an alive ovs agent."""
+        agents = self._topology.agents('Open vSwitch agent')
+        return set(agent['host'] for agent in agents if agent['alive'])
+
+    def _audit_host(self, queue, host_ports, segmentation_ids, dry_run,
+                    report):
+        while True:
+            try:
+                host = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                report[host] = self.repair_host(host, host_ports[host],
+                                                segmentation_ids, dry_run)
+            except Exception as e:
+                LOG.error("Failed to audit host %s - %s" % (host, e))
+                report[host] = e
+
+    def audit(self, hosts=None, concurrency=32, dry_run=False):
+        """Check every compute host in parallel, return {host: fixed}.
+
+        Ports and networks are listed once for the whole fleet, failed
+        hosts are reported with the exception instead of the ports.
+        """
+        if hosts is None:
+            hosts = self.compute_hosts()
+        ports = self._neutron.list_ports().get('ports', [])
+        segmentation_ids = self.segmentation_ids()
+        host_ports = dict((host, []) for host in hosts)
+        for port in ports:
+            if port['device_owner'].startswith('compute:') and \
+                    port.get('binding:host_id') in host_ports:
+                host_ports[port['binding:host_id']].append(port)
+        queue = Queue.Queue()
+        for host in sorted(host_ports):
+            if host_ports[host]:
+                queue.put(host)
+        LOG.info("Audit %d ports on %d hosts, concurrency %d" % (
+            len(ports), queue.qsize(), concurrency))
+        report = {}
+        workers = [threading.Thread(target=self._audit_host,
+                                    args=(queue, host_ports,
+                                          segmentation_ids, dry_run, report))
+                   for _ in range(min(concurrency, queue.qsize()))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return report
+
+
+def print_report(report, dry_run=False):
+    """Print ports need fixing or fixed, and hosts failed to audit."""
+    action = "need fix" if dry_run else "fixed"
+    failed = [host for host in report if isinstance(report[host], Exception)]
+    total = 0
+    for host in sorted(report):
+        if host in failed or not report[host]:
+            continue
+        total += len(report[host])
+        print("%s: %d ports %s - %s" % (
+            host, len(report[host]), action,
+            ", ".join(port['id'] for port in report[host])))
+    print("[%d] hosts, %d ports %s, %d hosts failed: %s" % (
+        len(report), total, action, len(failed), sorted(failed)))
+
+
+if __name__ == '__main__':
+    # ensure environment has necessary items to authenticate
+    for key in ['OS_TENANT_NAME', 'OS_USERNAME', 'OS_PASSWORD',
+                'OS_AUTH_URL']:
+        if key not in os.environ.keys():
+            LOG.error("Your environment is missing '%s'" % key)
+            exit(1)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("uuid", nargs='?', help="instance uuid")
+    parser.add_argument('-k', '--insecure', action='store_true',
+                        default=False, help='allow connections to SSL sites '
+                                            'without certs')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help='only show the ports need to be fixed')
+    parser.add_argument('--all', action='store_true', default=False,
+                        help='audit all compute hosts instead of one instance')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='max hosts audited at the same time')
+    args = parser.parse_args()
+    if not (args.uuid or args.all):
+        parser.error("uuid or --all is required")
+
+    neutron = neutron_client.Client(
+        auth_url=os.environ.get('OS_AUTH_URL'),
+        username=os.environ.get('OS_USERNAME'),
+        tenant_name=os.environ.get('OS_TENANT_NAME'),
+        password=os.environ.get('OS_PASSWORD'),
+        endpoint_type=os.environ.get('OS_ENDPOINT_TYPE', 'publicURL'),
+        insecure=args.insecure)
+    tagger = QvoTagger(neutron)
+    if args.all:
+        print_report(tagger.audit(concurrency=args.concurrency,
+                                  dry_run=args.dry_run), args.dry_run)
+    else:
+        tagger.repair_instance(args.uuid, dry_run=args.dry_run)
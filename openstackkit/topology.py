@@ -0,0 +1,124 @@
+# @author wtie@cisco.com
+# Shared cache of neutron topology for the tools of the kit.
+#
+# Agents and networks are listed with one call each and kept for ttl
+# seconds. Ports are listed on demand by device, one call for all devices
+# missing from the cache.
+import threading
+import time
+
+
+class TopologyCache(object):
+    """Agents by id and host, networks by id and ports by device."""
+
+    def __init__(self, neutron, ttl=60, clock=time.time):
+        self._neutron = neutron
+        self._ttl = ttl
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._loaded = {}
+        self._agents = {}
+        self._agents_by_host = {}
+        self._networks = {}
+        self._ports = {}
+
+    def _fresh(self, key):
+        loaded = self._loaded.get(key)
+        return loaded is not None and self._clock() - loaded < self._ttl
+
+    def invalidate(self, kind=None):
+        """Drop agents, networks or ports, everything if kind is None."""
+        with self._lock:
+            for key in list(self._loaded):
+                if kind is None or key == kind or \
+                        (isinstance(key, tuple) and key[0] == kind):
+                    del self._loaded[key]
+
+    def _load_agents(self, force=False):
+        with self._lock:
+            if self._fresh('agents') and not force:
+                return
+            agents = self._neutron.list_agents().get('agents', [])
+            self._agents = dict((agent['id'], agent) for agent in agents)
+            self._agents_by_host = {}
+            for agent in agents:
+                self._agents_by_host.setdefault(agent['host'],
+                                                []).append(agent)
+            self._loaded['agents'] = self._clock()
+
+    def agents(self, agent_type=None, host=None):
+        """Return agents of type and host, all of them if not given."""
+        self._load_agents()
+        if host is not None:
+            agents = self._agents_by_host.get(host, [])
+        else:
+            agents = self._agents.values()
+        return [agent for agent in agents
+                if agent_type is None or agent['agent_type'] == agent_type]
+
+    def agent(self, id_or_host, agent_type=None):
+        """Return the agent with this id, or of this type on this host."""
+        for force in (False, True):
+            if force:
+                # may be a new agent, look again in a fresh listing
+                self._load_agents(force=True)
+            agent = self._agents.get(id_or_host)
+            if agent is not None:
+                return agent
+            agents = self.agents(agent_type, host=id_or_host)
+            if agents:
+                return agents[0]
+        return None
+
+    def _load_networks(self, force=False):
+        with self._lock:
+            if self._fresh('networks') and not force:
+                return
+            networks = self._neutron.list_networks().get('networks', [])
+            self._networks = dict((network['id'], network)
+                                  for network in networks)
+            self._loaded['networks'] = self._clock()
+
+    def network(self, network_id):
+        self._load_networks()
+        if network_id not in self._networks:
+            self._load_networks(force=True)
+        return self._networks.get(network_id)
+
+    def segmentation_ids(self, network_ids=None):
+        """Return {network_id: segmentation_id}."""
+        self._load_networks()
+        if network_ids is None:
+            network_ids = self._networks.keys()
+        elif [one for one in network_ids if one not in self._networks]:
+            self._load_networks(force=True)
+        return dict((network_id, self._networks[network_id].get(
+            'provider:segmentation_id'))
+            for network_id in network_ids if network_id in self._networks)
+
+    def add_ports(self, ports, device_ids=()):
+        """Cache ports listed by the caller, devices without port too."""
+        with self._lock:
+            now = self._clock()
+            listed = set()
+            for device_id in list(device_ids) + [port['device_id']
+                                                 for port in ports]:
+                if device_id not in listed:
+                    listed.add(device_id)
+                    self._ports[device_id] = []
+                    self._loaded[('ports', device_id)] = now
+            for port in ports:
+                self._ports[port['device_id']].append(port)
+
+    def device_ports(self, device_ids):
+        """Return {device_id: [port]}, listing missing devices at once."""
+        device_ids = list(device_ids)
+        with self._lock:
+            missing = [device_id for device_id in device_ids
+                       if not self._fresh(('ports', device_id))]
+            if missing:
+                ports = self._neutron.list_ports(
+                    device_id=missing).get('ports', [])
+                self.add_ports(ports, missing)
+            return dict((device_id, list(self._ports[device_id]))
+                        for device_id in device_ids)